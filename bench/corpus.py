@@ -0,0 +1,60 @@
+"""
+Deterministic synthetic corpora for the benchmarks: plain text documents made of
+sentences over a Zipf-distributed vocabulary, and questions drawn from the same words.
+"""
+import os
+import numpy as np
+
+SYLLABLES = ["ka", "lo", "mi", "ne", "ra", "su", "ti", "vo", "ze", "an", "el", "is", "or", "um", "ba", "de"]
+
+def vocabulary(size, seed=0):
+    rng = np.random.default_rng(seed)
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES, rng.integers(2, 5))))
+    # shuffled so the frequent ranks are not all alphabetically first
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+def sentence(rng, words):
+    # Zipf ranks give a few very common words and a long tail, like natural text
+    ranks = np.minimum(rng.zipf(1.3, size=int(rng.integers(6, 22))), len(words)) - 1
+    text = " ".join(words[rank] for rank in ranks)
+    return text[0].upper() + text[1:] + "."
+
+def write_corpus(folder, docs=50, words_per_doc=2000, vocabulary_size=5000, seed=0):
+    """
+    Writes docs text files to folder. Returns:
+      the list of file paths
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    words = vocabulary(vocabulary_size, seed)
+    paths = []
+    for i in range(docs):
+        paragraphs = []
+        written = 0
+        while written < words_per_doc:
+            paragraph = " ".join(sentence(rng, words) for _ in range(int(rng.integers(3, 8))))
+            paragraphs.append(paragraph)
+            written += paragraph.count(" ") + 1
+        path = os.path.join(folder, f"doc{i:05d}.txt")
+        with open(path, "w") as f:
+            f.write("\n\n".join(paragraphs))
+        paths.append(path)
+    return paths
+
+def make_queries(count=50, vocabulary_size=5000, seed=1):
+    """
+    Questions of a few mid-frequency words each, all different so no query is a cache hit
+    """
+    rng = np.random.default_rng(seed)
+    words = vocabulary(vocabulary_size, 0)
+    queries = []
+    while len(queries) < count:
+        picked = [words[int(rank)] for rank in rng.integers(20, min(500, len(words)), size=int(rng.integers(3, 7)))]
+        query = "What is said about " + " ".join(picked) + "?"
+        if query not in queries:
+            queries.append(query)
+    return queries
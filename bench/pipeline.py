@@ -0,0 +1,220 @@
+"""
+Throughput of import.py and rag_langchain/ingest.py, and query latency of generate.py
+and rag_langchain/run_rag.py, against the stub Ollama server in bench/stub_ollama.py and a
+synthetic corpus, so runs are repeatable without a model server or GPU.
+import.py runs with the local vector backend. The langchain scripts are copied into the
+work directory so their DB, BM25 index and cache files do not touch the real ones.
+The langchain clients always connect to localhost:11434, so the stub takes that port by
+default; stop a running Ollama first.
+Run from the repository root: python bench/pipeline.py
+Save a baseline with --save baseline.json and check later runs with --compare baseline.json.
+"""
+import os, sys, json, time, shutil, socket, tempfile, argparse, subprocess, configparser
+import numpy as np
+import requests
+
+BENCH_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIRECTORY = os.path.dirname(BENCH_DIRECTORY)
+from stub_ollama import StubOllama, add_stub_arguments, stub_settings
+from corpus import write_corpus, make_queries
+
+STAGES = ["import", "ingest", "generate", "run_rag"]
+
+RAG_DRIVER = """
+import sys, json, time
+import run_rag
+results = []
+for question in json.load(sys.stdin):
+    start = time.perf_counter()
+    first = None
+    for chunk in run_rag.rag_chain.stream(question):
+        if first is None and chunk.content:
+            first = time.perf_counter()
+    end = time.perf_counter()
+    results.append([(first or end) - start, end - start])
+print(json.dumps(results))
+"""
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+def run_script(args, cwd, env, input=None):
+    """
+    Runs a script to completion. Returns:
+      (seconds, stdout)
+    """
+    start = time.perf_counter()
+    result = subprocess.run(args, cwd=cwd, env=env, input=input, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(args[:2])} failed:\n{result.stderr[-2000:]}")
+    return seconds, result.stdout
+
+def write_config(workdir, query_port):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT_DIRECTORY, "config.ini"))
+    # fresh in-process store and no embedding cache, so every chunk is embedded and written
+    config["main"].update({
+        "vector_backend": "local",
+        "vector_path": "vectors",
+        "ivf_lists": "0",
+        "vector_codes": "none",
+        "incremental": "false",
+        "embed_cache": "false",
+        "query_service_port": str(query_port),
+    })
+    with open(os.path.join(workdir, "config.ini"), "w") as f:
+        config.write(f)
+
+def throughput(seconds, docs, chunks):
+    return {"seconds": seconds, "chunks": chunks, "docs_per_sec": docs / seconds, "chunks_per_sec": chunks / seconds}
+
+def latency(samples):
+    ttft, total = np.array(samples).T * 1000
+    return {"queries": len(samples),
+            "ttft_p50_ms": float(np.percentile(ttft, 50)), "ttft_p99_ms": float(np.percentile(ttft, 99)),
+            "p50_ms": float(np.percentile(total, 50)), "p99_ms": float(np.percentile(total, 99))}
+
+def bench_import(workdir, corpus, docs, stub, env):
+    shutil.copytree(corpus, os.path.join(workdir, "SOURCE_DOCUMENTS"))
+    before = stub.snapshot()["embedded"]
+    seconds, _ = run_script([sys.executable, os.path.join(ROOT_DIRECTORY, "import.py")], workdir, env)
+    return throughput(seconds, docs, stub.snapshot()["embedded"] - before)
+
+def bench_ingest(ragdir, corpus, docs, stub, env):
+    shutil.copytree(corpus, os.path.join(ragdir, "SOURCE_DOCUMENTS"))
+    before = stub.snapshot()["embedded"]
+    seconds, _ = run_script([sys.executable, "ingest.py"], ragdir, env)
+    return throughput(seconds, docs, stub.snapshot()["embedded"] - before)
+
+def bench_generate(workdir, queries, warmup, port, env):
+    # the query service keeps clients and caches warm, as a long running deployment would
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT_DIRECTORY, "generate.py"), "--serve"],
+                              cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        samples = []
+        with requests.Session() as session:
+            for query in queries:
+                start = time.perf_counter()
+                first = None
+                with session.post(f"http://127.0.0.1:{port}/query", json={"query": query}, stream=True) as r:
+                    r.raise_for_status()
+                    for line in r.iter_lines():
+                        if first is None and json.loads(line).get("response"):
+                            first = time.perf_counter()
+                end = time.perf_counter()
+                samples.append([(first or end) - start, end - start])
+    finally:
+        server.terminate()
+        server.wait()
+    return latency(samples[warmup:])
+
+def bench_run_rag(ragdir, queries, warmup, env):
+    _, stdout = run_script([sys.executable, "-c", RAG_DRIVER], ragdir, env, input=json.dumps(queries))
+    samples = json.loads(stdout.strip().splitlines()[-1])
+    return latency(samples[warmup:])
+
+def compare(baseline, results, tolerance):
+    """
+    Returns a line for every metric that got worse by more than tolerance
+    """
+    regressions = []
+    for stage, metrics in results.items():
+        for name, value in metrics.items():
+            old = baseline.get(stage, {}).get(name)
+            if old is None:
+                continue
+            if name.endswith("_per_sec") and value < old * (1 - tolerance):
+                regressions.append(f"{stage} {name}: {old:.1f} -> {value:.1f}")
+            if name.endswith("_ms") and value > old * (1 + tolerance):
+                regressions.append(f"{stage} {name}: {old:.1f} -> {value:.1f}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_stub_arguments(parser)
+    parser.add_argument("--docs", type=int, default=50)
+    parser.add_argument("--words", type=int, default=2000, help="words per document")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=2, help="queries run first and left out of the latencies")
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file from an earlier --save")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--keep", action="store_true", help="keep the work directory")
+    args = parser.parse_args()
+    stages = [stage for stage in args.stages.split(",") if stage]
+    if args.port != 11434 and {"ingest", "run_rag"} & set(stages):
+        print("The langchain scripts only use localhost:11434, their stages will not reach the stub")
+
+    stub = StubOllama(args.port, stub_settings(args)).start()
+    workdir = tempfile.mkdtemp(prefix="rag-bench-")
+    ragdir = os.path.join(workdir, "rag_langchain")
+    os.makedirs(ragdir)
+    for script in ("ingest.py", "run_rag.py"):
+        shutil.copy(os.path.join(ROOT_DIRECTORY, "rag_langchain", script), ragdir)
+    query_port = free_port()
+    write_config(workdir, query_port)
+    corpus = os.path.join(workdir, "corpus")
+    write_corpus(corpus, args.docs, args.words)
+    queries = make_queries(args.queries + args.warmup)
+    env = dict(os.environ, OLLAMA_HOST=stub.host,
+               PYTHONPATH=os.pathsep.join(filter(None, [ROOT_DIRECTORY, os.environ.get("PYTHONPATH")])))
+
+    results = {}
+    try:
+        for stage in stages:
+            print(f"Running {stage}...", flush=True)
+            if stage == "import":
+                results[stage] = bench_import(workdir, corpus, args.docs, stub, env)
+            elif stage == "ingest":
+                results[stage] = bench_ingest(ragdir, corpus, args.docs, stub, env)
+            elif stage == "generate":
+                results[stage] = bench_generate(workdir, queries, args.warmup, query_port, env)
+            elif stage == "run_rag":
+                results[stage] = bench_run_rag(ragdir, queries, args.warmup, env)
+            else:
+                raise ValueError(f"Unknown stage: {stage}")
+    finally:
+        stub.stop()
+        if args.keep:
+            print(f"Work directory kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\n{args.docs} docs x {args.words} words, {args.queries} queries, "
+          f"stub latency {args.latency * 1000:.0f}ms, {args.token_rate:.0f} tokens/s")
+    for stage, metrics in results.items():
+        if "docs_per_sec" in metrics:
+            print(f"{stage:>9}: {metrics['docs_per_sec']:8.2f} docs/s {metrics['chunks_per_sec']:9.1f} chunks/s"
+                  f" ({metrics['chunks']} chunks in {metrics['seconds']:.1f}s)")
+        else:
+            print(f"{stage:>9}: p50 {metrics['p50_ms']:7.0f}ms  p99 {metrics['p99_ms']:7.0f}ms"
+                  f"  ttft p50 {metrics['ttft_p50_ms']:6.0f}ms  p99 {metrics['ttft_p99_ms']:6.0f}ms")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        for line in regressions:
+            print("Regression:", line)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
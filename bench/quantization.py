@@ -0,0 +1,67 @@
+"""
+Recall@k against memory for the compact vector encodings of LocalCollection,
+on a synthetic clustered corpus shaped like nomic-embed-text output.
+Run from the repository root: python bench/quantization.py
+"""
+import os, sys, time, shutil, tempfile, argparse
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from vectorstore import LocalCollection
+
+def synthetic_corpus(n, dim, clusters, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    vectors = centers[rng.integers(0, clusters, n)] + 0.6 * rng.normal(size=(n, dim))
+    queries = centers[rng.integers(0, clusters, 200)] + 0.6 * rng.normal(size=(200, dim))
+    return vectors.astype(np.float32), queries.astype(np.float32)
+
+def recall(collection, queries, truth, k):
+    hits = 0
+    start = time.perf_counter()
+    for query, expected in zip(queries, truth):
+        found = collection.query([query], n_results=k, include=())["ids"][0]
+        hits += len(set(found) & expected)
+    return hits / (k * len(queries)), (time.perf_counter() - start) / len(queries)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    vectors, queries = synthetic_corpus(args.n, args.dim, clusters=max(1, args.n // 200))
+    ids = [str(i) for i in range(args.n)]
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    scores = normalized @ (queries / np.linalg.norm(queries, axis=1, keepdims=True)).T
+    truth = [set(ids[i] for i in np.argsort(-column)[:args.k]) for column in scores.T]
+
+    configs = [("float32", None, None), ("float16", None, None),
+               ("float32", "int8", None), ("float32", "pq", 96), ("float32", "pq", 48), ("float32", "pq", 16)]
+    print(f"{args.n} vectors of {args.dim} dims, recall@{args.k} over {len(queries)} queries\n")
+    print(f"{'encoding':<22}{'search bytes/vec':>17}{'no re-rank':>12}{'re-rank x10':>13}{'ms/query':>10}")
+    for dtype, kind, m in configs:
+        path = tempfile.mkdtemp()
+        try:
+            collection = LocalCollection(path, dtype=dtype)
+            for start in range(0, args.n, 5000):
+                collection.add(ids[start:start + 5000], vectors[start:start + 5000])
+            name = dtype
+            if kind:
+                collection.build_codes(kind, pq_m=m or 16)
+                name = f"{kind} m={m}" if kind == "pq" else kind
+            search_bytes = collection.codes[1][0].nbytes if kind else np.dtype(dtype).itemsize * args.dim
+            # without codes the search is already exact, so there is nothing to re-rank
+            plain = "-"
+            if kind:
+                collection.rerank = 1
+                plain = f"{recall(collection, queries, truth, args.k)[0]:.3f}"
+            collection.rerank = 10
+            reranked, latency = recall(collection, queries, truth, args.k)
+            print(f"{name:<22}{search_bytes:>17}{plain:>12}{reranked:>13.3f}{latency * 1000:>10.2f}")
+        finally:
+            shutil.rmtree(path)
+
+if __name__ == "__main__":
+    main()
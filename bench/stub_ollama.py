@@ -0,0 +1,197 @@
+"""
+A stand-in for the Ollama server for benchmarks: answers /api/embeddings, /api/embed,
+/api/generate and /api/chat with deterministic output after a configurable delay.
+Embeddings are hashed bags of words, so similar texts get similar vectors and retrieval
+still behaves like retrieval. Generation streams a fixed answer at a fixed token rate
+after a prefill delay proportional to the prompt length.
+Run on its own with: python bench/stub_ollama.py --port 11434
+"""
+import json, re, time, zlib, argparse, threading
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+WORD = re.compile(r"\w+")
+ANSWER = ("The context describes the requested topic in some detail and the answer follows from it. "
+          "It lists the main points, explains how they relate and ends with a short summary.")
+
+class StubSettings:
+    """
+    latency: seconds added to every request
+    embed_latency: seconds added per embedded text
+    prefill_rate: prompt tokens processed per second before the first token
+    token_rate: generated tokens per second
+    answer_tokens: length of every generated answer
+    """
+    def __init__(self, latency=0.005, embed_latency=0.002, prefill_rate=2000.0, token_rate=100.0,
+                 answer_tokens=64, dim=768):
+        self.latency = latency
+        self.embed_latency = embed_latency
+        self.prefill_rate = prefill_rate
+        self.token_rate = token_rate
+        self.answer_tokens = answer_tokens
+        self.dim = dim
+
+def embed_text(text, dim):
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in WORD.findall(text.lower()):
+        h = zlib.crc32(word.encode())
+        vector[h % dim] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).round(6).tolist()
+
+def answer_tokens(count):
+    words = ANSWER.split(" ")
+    return [(" " if i else "") + words[i % len(words)] for i in range(count)]
+
+class StubOllama:
+    """
+    Runs the stub server on a background thread and counts what it was asked to do
+    """
+    def __init__(self, port=11434, settings=None):
+        self.settings = settings or StubSettings()
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "embedded": 0, "generated": 0}
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.host = f"http://127.0.0.1:{self.port}"
+
+    def count(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.stats[name] += value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def send_json(self, body):
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_chunk(self, body):
+                data = (json.dumps(body) + "\n").encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+
+            def do_GET(self):
+                if self.path in ("/", "/api/version", "/api/tags"):
+                    self.send_json({"version": "stub", "models": []})
+                else:
+                    self.send_error(404)
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                settings = stub.settings
+                stub.count(requests=1)
+                time.sleep(settings.latency)
+                if self.path == "/api/embeddings":
+                    stub.count(embedded=1)
+                    time.sleep(settings.embed_latency)
+                    self.send_json({"embedding": embed_text(body.get("prompt", ""), settings.dim)})
+                elif self.path == "/api/embed":
+                    texts = body.get("input", [])
+                    texts = [texts] if isinstance(texts, str) else texts
+                    stub.count(embedded=len(texts))
+                    time.sleep(settings.embed_latency * len(texts))
+                    self.send_json({"model": body.get("model"), "embeddings": [embed_text(text, settings.dim) for text in texts]})
+                elif self.path in ("/api/generate", "/api/chat"):
+                    self.generate(body, chat=self.path == "/api/chat")
+                else:
+                    self.send_error(404)
+
+            def generate(self, body, chat):
+                settings = stub.settings
+                if chat:
+                    prompt = " ".join(message.get("content", "") for message in body.get("messages", []))
+                else:
+                    prompt = body.get("prompt", "")
+                prompt_tokens = len(WORD.findall(prompt))
+                # an empty prompt only loads the model, as QueryEngine.warm() does
+                tokens = answer_tokens(settings.answer_tokens if prompt_tokens else 0)
+                prefill = prompt_tokens / settings.prefill_rate
+                time.sleep(prefill)
+
+                def chunk(token, done):
+                    base = {"model": body.get("model"), "created_at": "1970-01-01T00:00:00Z", "done": done}
+                    if chat:
+                        base["message"] = {"role": "assistant", "content": token}
+                    else:
+                        base["response"] = token
+                    if done:
+                        base.update(done_reason="stop", prompt_eval_count=prompt_tokens,
+                                    prompt_eval_duration=int(prefill * 1e9), eval_count=len(tokens),
+                                    eval_duration=int(len(tokens) / settings.token_rate * 1e9),
+                                    total_duration=int((prefill + len(tokens) / settings.token_rate) * 1e9))
+                    return base
+
+                stub.count(generated=len(tokens))
+                if not body.get("stream", True):
+                    time.sleep(len(tokens) / settings.token_rate)
+                    final = chunk("".join(tokens), True)
+                    self.send_json(final)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for token in tokens:
+                    time.sleep(1 / settings.token_rate)
+                    self.send_chunk(chunk(token, False))
+                self.send_chunk(chunk("", True))
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+def add_stub_arguments(parser):
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds added to every request")
+    parser.add_argument("--embed-latency", type=float, default=0.002, help="seconds per embedded text")
+    parser.add_argument("--prefill-rate", type=float, default=2000.0, help="prompt tokens per second")
+    parser.add_argument("--token-rate", type=float, default=100.0, help="generated tokens per second")
+    parser.add_argument("--answer-tokens", type=int, default=64)
+    parser.add_argument("--dim", type=int, default=768)
+
+def stub_settings(args):
+    return StubSettings(args.latency, args.embed_latency, args.prefill_rate, args.token_rate, args.answer_tokens, args.dim)
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    stub = StubOllama(args.port, stub_settings(args))
+    print(f"Stub Ollama listening on {stub.host}")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import os, re, math, pickle
+from bisect import bisect_left
+from array import array
+from collections import Counter
+
+TERM = re.compile(r"\w+(?:[-.]\w+)*")
+
+def tokenize(text):
+    """
+    Lowercased word tokens. Compound tokens such as part numbers (ab-1234) or dotted names
+    (os.path) are kept whole and also split into their parts.
+    """
+    terms = []
+    for match in TERM.finditer(text.lower()):
+        term = match.group()
+        terms.append(term)
+        if '-' in term or '.' in term:
+            terms.extend(re.split(r"[-.]", term))
+    return terms
+
+class BM25Index:
+    """
+    Local inverted index scored with BM25.
+    Postings are kept per term as two parallel arrays of document numbers and term frequencies.
+    Removed documents are tombstoned and dropped from the postings on save.
+    """
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.terms = {}
+        self.postings_docs = []
+        self.postings_freqs = []
+        self.doc_ids = []
+        self.doc_lengths = array('I')
+        self.doc_numbers = {}
+        self.deleted = set()
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.doc_numbers)
+
+    def add(self, doc_id, text):
+        if doc_id in self.doc_numbers:
+            self.remove(doc_id)
+        number = len(self.doc_ids)
+        terms = tokenize(text)
+        self.doc_ids.append(doc_id)
+        self.doc_lengths.append(len(terms))
+        self.doc_numbers[doc_id] = number
+        self.total_length += len(terms)
+        for term, freq in Counter(terms).items():
+            term_id = self.terms.get(term)
+            if term_id is None:
+                term_id = self.terms[term] = len(self.postings_docs)
+                self.postings_docs.append(array('I'))
+                self.postings_freqs.append(array('I'))
+            self.postings_docs[term_id].append(number)
+            self.postings_freqs[term_id].append(freq)
+
+    def remove(self, doc_id):
+        number = self.doc_numbers.pop(doc_id, None)
+        if number is not None:
+            self.deleted.add(number)
+            self.total_length -= self.doc_lengths[number]
+
+    def search(self, query, k=10):
+        """
+        Returns:
+          list of (doc_id, score) for the k best matching documents
+        """
+        n_docs = len(self.doc_numbers)
+        if n_docs == 0:
+            return []
+        avg_length = self.total_length / n_docs
+        scores = Counter()
+        for term in set(tokenize(query)):
+            term_id = self.terms.get(term)
+            if term_id is None:
+                continue
+            docs, freqs = self.postings_docs[term_id], self.postings_freqs[term_id]
+            df = len(docs) - sum(1 for number in docs if number in self.deleted) if self.deleted else len(docs)
+            if df == 0:
+                continue
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            for number, freq in zip(docs, freqs):
+                if number in self.deleted:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[number] / avg_length)
+                scores[number] += idf * freq * (self.k1 + 1) / (freq + norm)
+        return [(self.doc_ids[number], score) for number, score in scores.most_common(k)]
+
+    def confident(self, query, results, ratio=2.0):
+        """
+        True when the best lexical match contains every query term and clearly beats the runner-up,
+        as for exact lookups of part numbers or function names
+        """
+        if not results:
+            return False
+        number = self.doc_numbers[results[0][0]]
+        for term in set(tokenize(query)):
+            term_id = self.terms.get(term)
+            if term_id is None:
+                return False
+            # postings are in ascending document order
+            docs = self.postings_docs[term_id]
+            position = bisect_left(docs, number)
+            if position == len(docs) or docs[position] != number:
+                return False
+        return len(results) == 1 or results[0][1] >= ratio * results[1][1]
+
+    def compact(self):
+        """
+        Renumbers documents without the tombstoned ones
+        """
+        if not self.deleted:
+            return
+        renumber = {}
+        doc_ids, doc_lengths = [], array('I')
+        for number, doc_id in enumerate(self.doc_ids):
+            if number not in self.deleted:
+                renumber[number] = len(doc_ids)
+                doc_ids.append(doc_id)
+                doc_lengths.append(self.doc_lengths[number])
+        terms, postings_docs, postings_freqs = {}, [], []
+        for term, term_id in self.terms.items():
+            docs, freqs = array('I'), array('I')
+            for number, freq in zip(self.postings_docs[term_id], self.postings_freqs[term_id]):
+                if number in renumber:
+                    docs.append(renumber[number])
+                    freqs.append(freq)
+            if docs:
+                terms[term] = len(postings_docs)
+                postings_docs.append(docs)
+                postings_freqs.append(freqs)
+        self.terms, self.postings_docs, self.postings_freqs = terms, postings_docs, postings_freqs
+        self.doc_ids, self.doc_lengths = doc_ids, doc_lengths
+        self.doc_numbers = {doc_id: number for number, doc_id in enumerate(doc_ids)}
+        self.deleted = set()
+
+    def save(self, path):
+        self.compact()
+        tmp = path + ".tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                index.__dict__.update(pickle.load(f))
+        return index
+
+def fuse(*rankings, k=60):
+    """
+    Reciprocal rank fusion of several lists of ids in rank order.
+    Returns:
+      dict of id to fused score, higher is better
+    """
+    scores = Counter()
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] += 1 / (k + rank + 1)
+    return dict(scores)
@@ -1,22 +1,35 @@
+import asyncio, logging
 import gradio as gr
-import ollama
+from chatservice import Busy, ChatService, getchatconfig
+from conversation import ConversationWindow, ollama_summarize
+from streaming import achat_tokens, acoalesce_text
+from utilities import getconfig
 
-def format_history(msg: str, history: list[list[str, str]], system_prompt: str):
-    chat_history = [{"role": "system", "content":system_prompt}]
-    for query, response in history:
-        chat_history.append({"role": "user", "content": query})
-        chat_history.append({"role": "assistant", "content": response})  
-    chat_history.append({"role": "user", "content": msg})
-    return chat_history
+chatconfig = getchatconfig(getconfig())
+# one async client and connection pool shared by every browser session
+service = ChatService(**chatconfig)
+logger = logging.getLogger(__name__)
 
-def generate_response(msg: str, history: list[list[str, str]], system_prompt: str):
-    chat_history = format_history(msg, history, system_prompt)
-    response = ollama.chat(model='llama2', stream=True, messages=chat_history)
-    message = ""
-    for partial_resp in response:
-        token = partial_resp["message"]["content"]
-        message += token
-        yield message
+# older turns are summarized once the conversation no longer fits in this many tokens
+window = ConversationWindow(ollama_summarize(chatconfig["model"]), budget_tokens=2048, fold_turns=4)
+
+async def generate_response(msg: str, history: list[list[str, str]], system_prompt: str, request: gr.Request):
+    # summarizing old turns is a blocking call, keep it off the event loop
+    chat_history = await asyncio.to_thread(window.messages, msg, history, system_prompt)
+    report = lambda chunk: window.report(chunk, chat_history)
+    try:
+        # a regenerate from the same browser session cancels the answer still streaming
+        chunks = service.stream(request.session_hash, chat_history)
+        # gradio re-renders the whole message on every yield, so updates are batched
+        async for message in acoalesce_text(achat_tokens(chunks, on_done=report)):
+            yield message
+    except Busy:
+        raise gr.Error("Too many people are chatting right now, please try again in a moment.")
+    finally:
+        logger.debug("chat service: %s", service.metrics())
+
+async def cancel_response(request: gr.Request):
+    service.cancel(request.session_hash)
 
 chatbot = gr.ChatInterface(
                 generate_response,
@@ -30,7 +43,7 @@ chatbot = gr.ChatInterface(
                         label="System Prompt"
                     )
                 ],
-                title="LLama-2 (7B) Chatbot using 'Ollama'",
+                title=f"{chatconfig['model']} Chatbot using 'Ollama'",
                 description="Feel free to ask any question.",
                 theme="soft",
                 submit_btn="⬅ Send",
@@ -39,4 +52,11 @@ chatbot = gr.ChatInterface(
                 clear_btn="🗑️ Clear Chat"
 )
 
+with chatbot:
+    for button in (chatbot.undo_btn, chatbot.clear_btn):
+        if button is not None:
+            button.click(cancel_response)
+
+# admission is handled by the service, gradio only needs to let the requests through
+chatbot.queue(default_concurrency_limit=chatconfig["max_concurrent"] + chatconfig["max_queue"])
 chatbot.launch()
\ No newline at end of file
@@ -1,5 +1,15 @@
+import uuid
 import streamlit as st
-import ollama
+from chatservice import Busy, ChatService, getchatconfig
+from streaming import TokenBuffer, chat_tokens, coalesce
+from utilities import getconfig
+
+@st.cache_resource
+def get_service():
+    # shared by all browser sessions: one connection pool, one event loop thread
+    return ChatService(**getchatconfig(getconfig())).start()
+
+service = get_service()
 
 # System prompt templates
 prompt_templates = [
@@ -19,6 +29,7 @@ if "messages" not in st.session_state:
     st.session_state["system_prompt"] = ""
     st.session_state["full_message"] = ""
     st.session_state["system_prompt_updated"] = False
+    st.session_state["session_id"] = uuid.uuid4().hex
 
 # Sidebar for system prompt selection or input
 with st.sidebar:
@@ -43,6 +54,7 @@ with st.sidebar:
         
         st.session_state["system_prompt_updated"] = True
         st.session_state["full_message"] = ""
+        service.cancel_threadsafe(st.session_state["session_id"])
 
 # Clear old assistant messages if system prompt is updated
 if st.session_state.get("system_prompt_updated"):
@@ -57,16 +69,26 @@ for msg in st.session_state.messages:
         st.chat_message(msg["role"], avatar="🤖").write(msg["content"])
 
 ## Generator for Streaming Tokens
-def generate_response():
-    response = ollama.chat(model='llama2', stream=True, messages=st.session_state.messages)
-    for partial_resp in response:
-        token = partial_resp["message"]["content"]
-        st.session_state["full_message"] += token
-        yield token
+def generate_response(buffer):
+    # a new question from the same session cancels the answer still streaming
+    response = service.stream_sync(st.session_state["session_id"], st.session_state.messages)
+    # write_stream appends each delta, so only the new text is sent to the page
+    for delta in coalesce(chat_tokens(response)):
+        buffer.append(delta)
+        yield delta
 
 if prompt := st.chat_input():
     st.session_state.messages.append({"role": "user", "content": prompt})
     st.chat_message("user", avatar="🧑‍💻").write(prompt)
-    st.session_state["full_message"] = ""
-    st.chat_message("assistant", avatar="🤖").write_stream(generate_response)
-    st.session_state.messages.append({"role": "assistant", "content": st.session_state["full_message"]})   
\ No newline at end of file
+    buffer = TokenBuffer()
+    try:
+        st.chat_message("assistant", avatar="🤖").write_stream(generate_response(buffer))
+    except Busy:
+        st.warning("Too many people are chatting right now, please try again in a moment.")
+        st.session_state.messages.pop()
+    else:
+        st.session_state["full_message"] = buffer.text()
+        st.session_state.messages.append({"role": "assistant", "content": st.session_state["full_message"]})
+
+with st.sidebar:
+    st.caption("Server: {active} generating, {waiting} waiting, {rejected} turned away".format(**service.metrics()))   
\ No newline at end of file
@@ -0,0 +1,141 @@
+import asyncio, functools, threading, time, httpx, ollama
+from collections import Counter
+
+class Busy(Exception):
+    """
+    Raised when every generation slot is taken and the wait queue is full
+    """
+
+class ChatService:
+    """
+    Streams chat completions for many sessions through one ollama.AsyncClient, so all
+    sessions share a single HTTP connection pool.
+    At most max_concurrent generations run at once and at most max_queue more may wait
+    for a slot; anything beyond that is rejected with Busy instead of piling up.
+    Starting a new stream for a session cancels the one still running for it.
+    """
+    def __init__(self, model, max_concurrent=4, max_queue=16, keep_alive=None, host=None):
+        self.model = model
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.keep_alive = keep_alive
+        limits = httpx.Limits(max_connections=max_concurrent, max_keepalive_connections=max_concurrent)
+        self.client = ollama.AsyncClient(host=host, limits=limits, timeout=None)
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.tasks = {}
+        self.pending = 0
+        self.active = 0
+        self.peak_waiting = 0
+        self.wait_time = 0.0
+        self.counts = Counter()
+        self.loop = None
+
+    def metrics(self):
+        admitted = self.counts["admitted"]
+        return {
+            "active": self.active,
+            "waiting": self.pending - self.active,
+            "peak_waiting": self.peak_waiting,
+            "avg_wait_ms": 1000 * self.wait_time / admitted if admitted else 0.0,
+            **{name: self.counts[name] for name in ("admitted", "rejected", "completed", "cancelled", "failed")},
+        }
+
+    async def _generate(self, messages, queue):
+        start = time.monotonic()
+        await self.slots.acquire()
+        self.wait_time += time.monotonic() - start
+        self.active += 1
+        try:
+            response = await self.client.chat(model=self.model, messages=messages, stream=True, keep_alive=self.keep_alive)
+            async for chunk in response:
+                queue.put_nowait(chunk)
+            self.counts["completed"] += 1
+        except Exception as e:
+            self.counts["failed"] += 1
+            queue.put_nowait(e)
+        finally:
+            self.active -= 1
+            self.slots.release()
+
+    def _finished(self, queue, task):
+        # runs even when the task was cancelled before it started
+        self.pending -= 1
+        if task.cancelled():
+            self.counts["cancelled"] += 1
+        queue.put_nowait(None)
+
+    def cancel(self, session):
+        """
+        Stops the generation running for session, if any. Must be called on the service's loop.
+        """
+        task = self.tasks.pop(session, None)
+        if task is not None:
+            task.cancel()
+
+    async def stream(self, session, messages):
+        """
+        Yields the streamed chat chunks for messages. A stream that was cancelled, by
+        cancel() or by a newer stream for the same session, simply ends.
+        """
+        self.cancel(session)
+        if self.pending >= self.max_concurrent + self.max_queue:
+            self.counts["rejected"] += 1
+            raise Busy(f"{self.active} generations running and {self.pending - self.active} waiting")
+        self.counts["admitted"] += 1
+        self.pending += 1
+        self.peak_waiting = max(self.peak_waiting, self.pending - self.active)
+        queue = asyncio.Queue()
+        task = asyncio.create_task(self._generate(messages, queue))
+        task.add_done_callback(functools.partial(self._finished, queue))
+        self.tasks[session] = task
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            # also stops the generation when the front end stops reading
+            if self.tasks.get(session) is task:
+                del self.tasks[session]
+            task.cancel()
+
+    def start(self):
+        """
+        Runs the service on its own event loop thread, for front ends that are not async
+        """
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        return self
+
+    def cancel_threadsafe(self, session):
+        self.loop.call_soon_threadsafe(self.cancel, session)
+
+    def stream_sync(self, session, messages):
+        """
+        Blocking version of stream() for use from other threads, after start()
+        """
+        chunks = self.stream(session, messages)
+
+        async def step():
+            return await chunks.__anext__()
+
+        try:
+            while True:
+                try:
+                    chunk = asyncio.run_coroutine_threadsafe(step(), self.loop).result()
+                except StopAsyncIteration:
+                    return
+                yield chunk
+        finally:
+            asyncio.run_coroutine_threadsafe(chunks.aclose(), self.loop).result()
+
+def getchatconfig(config):
+    return {
+        "model": config.get("chat_model", config["mainmodel"]),
+        "max_concurrent": int(config.get("chat_max_concurrent", 4)),
+        "max_queue": int(config.get("chat_max_queue", 16)),
+        "keep_alive": config.get("keep_alive", "30m"),
+    }
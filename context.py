@@ -0,0 +1,64 @@
+import re, math
+
+TOKEN = re.compile(r"\w+|[^\w\s]")
+
+def count_tokens(text):
+    """
+    Estimates the number of model tokens in text. Word pieces are counted and scaled,
+    which is close enough for llama-style tokenizers on English text.
+    """
+    return math.ceil(len(TOKEN.findall(text)) * 1.3)
+
+def shingles(text, size=5):
+    words = text.lower().split()
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def trim_overlap(passage, selected):
+    """
+    Cuts the parts of a passage that overlap, by character offsets, with already selected
+    passages from the same source. A selected passage inside this one leaves the text on
+    either side of it, joined by " ... ". Returns the remaining text, or None if nothing is left.
+    """
+    text, start, end = passage["text"], passage.get("start"), passage.get("end")
+    if start is None or end is None:
+        return text
+    pieces = [(start, end)]
+    for other in selected:
+        if other.get("source") != passage.get("source") or other.get("start") is None:
+            continue
+        pieces = [(piece_start, piece_end)
+                  for first, last in pieces
+                  for piece_start, piece_end in ((first, min(last, other["start"])), (max(first, other["end"]), last))
+                  if piece_start < piece_end]
+    parts = [text[first - start:last - start] for first, last in pieces]
+    parts = [part for part in parts if part.strip()]
+    return " ... ".join(parts) if parts else None
+
+def assemble_context(passages, budget=2048, dedup_threshold=0.8):
+    """
+    Packs the highest scoring passages into a token budget.
+    passages are dicts with "text" and "score" (higher is better) and optionally
+    "source", "start" and "end" character offsets. Overlapping chunks of the same source
+    are trimmed and near-duplicates (by word shingles) are dropped.
+    Returns:
+      list of texts in score order whose estimated tokens fit in budget
+    """
+    selected, seen, texts = [], [], []
+    used = 0
+    for passage in sorted(passages, key=lambda p: p["score"], reverse=True):
+        text = trim_overlap(passage, selected)
+        if text is None:
+            continue
+        grams = shingles(text)
+        if any(len(grams & other) / len(grams) >= dedup_threshold for other in seen):
+            continue
+        tokens = count_tokens(text)
+        if used + tokens > budget:
+            continue
+        used += tokens
+        selected.append(passage)
+        seen.append(grams)
+        texts.append(text)
+    return texts
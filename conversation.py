@@ -0,0 +1,94 @@
+import hashlib, json, logging, ollama
+from context import count_tokens
+from embedcache import LRUCache
+
+SUMMARY_PROMPT = """Update the notes about a conversation between a user and an assistant.
+Keep names, facts, decisions and open questions, drop small talk. Answer with the notes only.
+
+Current notes:
+{summary}
+
+New turns:
+{turns}"""
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+
+logger = logging.getLogger(__name__)
+
+def ollama_summarize(model):
+    def summarize(summary, turns):
+        text = "\n".join(f"User: {query}\nAssistant: {response}" for query, response in turns)
+        response = ollama.generate(model=model, prompt=SUMMARY_PROMPT.format(summary=summary or "(none)", turns=text))
+        return response["response"].strip()
+    return summarize
+
+class ConversationWindow:
+    """
+    Builds the message list for a chat turn within a token budget.
+    Older turns are folded into a summary fold_turns at a time, so between folds the
+    system prompt, summary and earlier turns stay byte-identical and the server can reuse
+    its cached prefix; only the new turns are prefilled.
+    The window is derived from the history on every call, so regenerate, undo and clear
+    need no extra state. Summaries are cached by the turns they cover.
+    """
+    def __init__(self, summarize, budget_tokens=2048, fold_turns=4, cache_size=256):
+        self.summarize = summarize
+        self.budget_tokens = budget_tokens
+        self.fold_turns = fold_turns
+        self.summaries = LRUCache(cache_size)
+        self.last_prompt_tokens = 0
+
+    def summary(self, system_prompt, turns):
+        if not turns:
+            return ""
+        # summaries build on each other one fold at a time, each keyed by a hash chained over
+        # the folds it covers, so the latest cached one is found without hashing every prefix anew
+        folds = [turns[i:i + self.fold_turns] for i in range(0, len(turns), self.fold_turns)]
+        keys = []
+        key = hashlib.sha256(json.dumps(system_prompt).encode()).hexdigest()
+        for fold in folds:
+            key = hashlib.sha256((key + json.dumps(fold)).encode()).hexdigest()
+            keys.append(key)
+        done, summary = 0, ""
+        for index in range(len(folds), 0, -1):
+            cached = self.summaries.get(keys[index - 1])
+            if cached is not None:
+                done, summary = index, cached
+                break
+        for index in range(done, len(folds)):
+            summary = self.summarize(summary, folds[index])
+            self.summaries.put(keys[index], summary)
+        return summary
+
+    def messages(self, msg, history, system_prompt):
+        history = [list(turn) for turn in history]
+        tokens = [count_tokens(query) + count_tokens(response) for query, response in history]
+        fixed = count_tokens(system_prompt) + count_tokens(msg)
+        # only whole folds are summarized so the summary changes rarely
+        folded = 0
+        while folded + self.fold_turns <= len(history) and fixed + sum(tokens[folded:]) > self.budget_tokens:
+            folded += self.fold_turns
+        summary = self.summary(system_prompt, history[:folded])
+        # the summary takes part of the budget too, fold further while it does not fit
+        while (summary and folded + self.fold_turns <= len(history)
+               and fixed + count_tokens(SUMMARY_HEADER + summary) + sum(tokens[folded:]) > self.budget_tokens):
+            folded += self.fold_turns
+            summary = self.summary(system_prompt, history[:folded])
+
+        chat_history = [{"role": "system", "content": system_prompt}]
+        if summary:
+            chat_history.append({"role": "system", "content": SUMMARY_HEADER + summary})
+        for query, response in history[folded:]:
+            chat_history.append({"role": "user", "content": query})
+            chat_history.append({"role": "assistant", "content": response})
+        chat_history.append({"role": "user", "content": msg})
+        self.last_prompt_tokens = sum(count_tokens(message["content"]) for message in chat_history)
+        return chat_history
+
+    def report(self, chunk, messages=None):
+        """
+        Logs prompt size and how many prompt tokens the server actually had to prefill, at debug level.
+        Pass the messages when several sessions share the window.
+        """
+        prompt = sum(count_tokens(message["content"]) for message in messages) if messages else self.last_prompt_tokens
+        prefill = chunk.get("prompt_eval_count")
+        logger.debug("prompt ~%d tokens, prefilled %s tokens", prompt, prefill if prefill is not None else "n/a")
@@ -0,0 +1,177 @@
+import time, sqlite3, hashlib, threading
+from array import array
+from collections import OrderedDict
+from metrics import metrics
+
+try:
+    from langchain_core.embeddings import Embeddings
+except ImportError:
+    Embeddings = object
+
+def normalize(text):
+    """
+    Collapses whitespace so chunks that only differ in spacing share a cache entry
+    """
+    return " ".join(text.split())
+
+def cache_key(model, text):
+    return hashlib.sha256((model + "\0" + normalize(text)).encode('utf-8', errors='ignore')).hexdigest()
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with an optional time to live in seconds
+    """
+    def __init__(self, maxsize=256, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            value, stored = item
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = (value, time.time())
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+class EmbeddingCache:
+    """
+    Disk-backed embedding cache in SQLite, keyed by embed model plus a hash of the normalized text.
+    Vectors are stored as float32 blobs and the least recently used rows are evicted
+    once the stored vectors exceed max_mb.
+    """
+    def __init__(self, path="embed_cache.sqlite", max_mb=1024):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+            key TEXT PRIMARY KEY, model TEXT, vector BLOB, size INTEGER, last_used REAL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+        self.db.commit()
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model, texts):
+        """
+        Returns a list with the cached vector for each text, or None where it is missing
+        """
+        keys = [cache_key(model, text) for text in texts]
+        found = {}
+        with self.lock:
+            # sqlite limits the number of bound parameters per statement
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = self.db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part)
+                found.update({key: array('f', blob).tolist() for key, blob in rows})
+            if found:
+                now = time.time()
+                self.db.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                    [(now, key) for key in found])
+                self.db.commit()
+            self.hits += len([key for key in keys if key in found])
+            self.misses += len([key for key in keys if key not in found])
+        return [found.get(key) for key in keys]
+
+    def put_many(self, model, texts, vectors):
+        now = time.time()
+        rows = []
+        for text, vector in zip(texts, vectors):
+            blob = array('f', vector).tobytes()
+            rows.append((cache_key(model, text), model, blob, len(blob), now))
+        with self.lock:
+            keys = [row[0] for row in rows]
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                replaced = self.db.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part)
+                self.total_bytes -= replaced.fetchone()[0]
+            self.db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows)
+            self.total_bytes += sum(row[3] for row in rows)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.db.commit()
+
+    def _evict(self, batch=256):
+        # drop the least recently used rows, a batch at a time through the last_used index,
+        # until the cache is back under 90% of its limit
+        target = self.max_bytes * 0.9
+        oldest = "SELECT key FROM embeddings ORDER BY last_used LIMIT ?"
+        while self.total_bytes > target:
+            freed = self.db.execute(f"SELECT COALESCE(SUM(size), 0), COUNT(*) FROM embeddings WHERE key IN ({oldest})",
+                                    (batch,)).fetchone()
+            if not freed[1]:
+                self.total_bytes = 0
+                break
+            self.db.execute(f"DELETE FROM embeddings WHERE key IN ({oldest})", (batch,))
+            self.total_bytes -= freed[0]
+
+    def embed(self, model, texts, embed_fn):
+        """
+        Returns embeddings for texts, calling embed_fn(missing_texts) only for cache misses
+        """
+        vectors = self.get_many(model, texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            fresh = embed_fn([texts[i] for i in missing])
+            for i, vector in zip(missing, fresh):
+                vectors[i] = vector
+            self.put_many(model, [texts[i] for i in missing], fresh)
+        return vectors
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def getcache(config):
+    """
+    Opens the embedding cache named in the config dict, or returns None if it is disabled
+    """
+    if config.get("embed_cache", "true").lower() != "true":
+        return None
+    return EmbeddingCache(config.get("embed_cache_path", "embed_cache.sqlite"),
+                          float(config.get("embed_cache_max_mb", 1024)))
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps a langchain embeddings object such as OllamaEmbeddings with an EmbeddingCache
+    """
+    def __init__(self, embeddings, cache, namespace=None):
+        self.embeddings = embeddings
+        self.cache = cache
+        # vectors from different backends are not interchangeable, so keep them apart in the cache
+        self.namespace = namespace or "langchain:" + getattr(embeddings, "model", type(embeddings).__name__)
+
+    def _embed_documents(self, texts):
+        with metrics.timer("embed"):
+            return self.embeddings.embed_documents(texts)
+
+    def _embed_query(self, texts):
+        with metrics.timer("embed"):
+            return [self.embeddings.embed_query(texts[0])]
+
+    def embed_documents(self, texts):
+        return self.cache.embed(self.namespace, list(texts), self._embed_documents)
+
+    def embed_query(self, text):
+        # query embeddings may use a different instruction prefix than documents
+        return self.cache.embed(self.namespace + ":query", [text], self._embed_query)[0]
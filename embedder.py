@@ -0,0 +1,67 @@
+import time, ollama
+from metrics import metrics
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+def batched(iterable, size):
+    """
+    Groups an iterable into lists of at most size items
+    """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+def embed_batch(batch, embedmodel, retries=3, backoff=1.0, cache=None):
+    """
+    Embeds a list of texts in one request, retrying with exponential backoff.
+    With a cache only the texts that are not cached yet are sent.
+    """
+    if cache is not None:
+        return cache.embed(embedmodel, batch, lambda texts: embed_batch(texts, embedmodel, retries, backoff))
+    for attempt in range(retries + 1):
+        try:
+            with metrics.timer("embed"):
+                embeddings = ollama.embed(model=embedmodel, input=batch)['embeddings']
+            if len(embeddings) != len(batch):
+                raise ValueError(f"Expected {len(batch)} embeddings, got {len(embeddings)}")
+            return embeddings
+        except Exception as ex:
+            if attempt == retries:
+                raise
+            delay = backoff * (2 ** attempt)
+            print(f"\nEmbedding batch failed ({ex}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def embed_chunks(chunks, embedmodel, batch_size=32, workers=4, retries=3, backoff=1.0, cache=None, key=None, embed=None):
+    """
+    Embeds chunks in batches over a bounded pool of workers.
+    Chunks can be any items if key returns the text to embed for each one.
+    embed, if given, is called with each batch of texts instead of embed_batch.
+    Returns:
+      generator of (chunk, embedding) pairs in the same order as the input
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for batch in batched(chunks, batch_size):
+            texts = [key(chunk) for chunk in batch] if key else batch
+            if embed is not None:
+                pending.append((batch, executor.submit(embed, texts)))
+            else:
+                pending.append((batch, executor.submit(embed_batch, texts, embedmodel, retries, backoff, cache)))
+            # keep at most two batches per worker in flight so memory stays bounded
+            if len(pending) >= workers * 2:
+                batch, future = pending.pop(0)
+                yield from zip(batch, future.result())
+        for batch, future in pending:
+            yield from zip(batch, future.result())
+
+def getembedconfig(config):
+    """
+    Reads the embedding pipeline settings from the config dict
+    """
+    return {
+        "batch_size": int(config.get("embed_batch_size", 32)),
+        "workers": int(config.get("embed_workers", 4)),
+        "retries": int(config.get("embed_retries", 3)),
+        "backoff": float(config.get("embed_backoff", 1.0)),
+    }
@@ -0,0 +1,99 @@
+import threading, queue
+from collections import namedtuple
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from utilities import fetch_url, iter_text_from_file, clean_path
+from metrics import metrics
+
+FetchResult = namedtuple('FetchResult', 'key url text not_modified etag last_modified error')
+
+def conditional_headers(entry, settings=None):
+    """
+    Builds If-None-Match / If-Modified-Since headers from a manifest entry.
+    None if the page was chunked with other settings, since it has to be chunked again anyway.
+    """
+    headers = {}
+    if settings is not None and entry and entry.get("settings") != settings:
+        return headers
+    if entry and entry.get("etag"):
+        headers['If-None-Match'] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers['If-Modified-Since'] = entry["last_modified"]
+    return headers
+
+class HostLimiter:
+    """
+    Limits the number of concurrent connections to each host
+    """
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.Semaphore(self.per_host)
+            return self.semaphores[host]
+
+def fetch_document(key, entry, limiter, timeout, settings=None):
+    url = clean_path(key)
+    try:
+        with ExitStack() as stack:
+            with limiter.get(url), metrics.timer("load"):
+                f, filetype, r = stack.enter_context(
+                    fetch_url(url, headers=conditional_headers(entry, settings), timeout=timeout))
+            # the body is in the spooled file, parsing it no longer holds a connection slot for the host
+            if f is None:
+                return FetchResult(key, url, None, True, None, None, None)
+            print(f"\nFetched {url} as {filetype}")
+            text = "".join(metrics.timed("extract", iter_text_from_file(f, filetype)))
+            return FetchResult(key, url, text, False, r.headers.get('etag'), r.headers.get('last-modified'), None)
+    except Exception as ex:
+        return FetchResult(key, url, None, False, None, None, ex)
+
+def fetch_documents(keys, manifest=None, workers=8, per_host=2, timeout=30, queue_size=4, settings=None):
+    """
+    Fetches and extracts many URLs concurrently.
+    Sends conditional requests using the ETag / Last-Modified recorded in the manifest,
+    unless the entry was chunked with other settings than the given chunker settings.
+    Returns:
+      generator of FetchResult in completion order. At most queue_size fetched documents
+      wait for the consumer, so fetching pauses while embedding catches up.
+    """
+    results = queue.Queue(maxsize=queue_size)
+    limiter = HostLimiter(per_host)
+    keys = list(keys)
+
+    def work(key):
+        entry = manifest.get(key) if manifest else None
+        results.put(fetch_document(key, entry, limiter, timeout, settings))
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = [executor.submit(work, key) for key in keys]
+    try:
+        for _ in keys:
+            yield results.get()
+    finally:
+        # if the consumer stops early, unblock workers waiting on the full queue
+        for future in futures:
+            future.cancel()
+        while not all(future.done() for future in futures):
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        executor.shutdown()
+
+def getfetchconfig(config):
+    """
+    Reads the web fetch settings from the config dict
+    """
+    return {
+        "workers": int(config.get("fetch_workers", 8)),
+        "per_host": int(config.get("fetch_per_host", 2)),
+        "timeout": float(config.get("fetch_timeout", 30)),
+        "queue_size": int(config.get("fetch_queue", 4)),
+    }
@@ -1,21 +1,46 @@
-import ollama, sys, chromadb
+import sys, json, requests
 from utilities import getconfig
+from query import QueryEngine, serve, format_timings
+from metrics import metrics, configure_metrics
 
-embedmodel = getconfig()["embedmodel"]
-mainmodel = getconfig()["mainmodel"]
-chroma = chromadb.HttpClient(host="localhost", port=8000)
-collection = chroma.get_or_create_collection("python-rag-ollama")
-
-query = " ".join(sys.argv[1:])
-queryembed = ollama.embeddings(model=embedmodel, prompt=query)['embedding']
+config = getconfig()
+configure_metrics(config)
+port = int(config.get("query_service_port", 8765))
 
+# python generate.py --serve keeps the clients and model warm for later queries
+if sys.argv[1:] == ["--serve"]:
+  serve(QueryEngine(config), port)
+  sys.exit()
 
-relevantdocs = collection.query(query_embeddings=[queryembed], n_results=5)["documents"][0]
-docs = "\n\n".join(relevantdocs)
-modelquery = f"{query} - Answer that question using the following text as a resource: {docs}"
+query = " ".join(sys.argv[1:])
 
-stream = ollama.generate(model=mainmodel, prompt=modelquery, stream=True)
+timings = {}
+try:
+  # use the running query service if there is one
+  with requests.post(f"http://127.0.0.1:{port}/query", json={"query": query}, stream=True, timeout=(0.2, None)) as r:
+    r.raise_for_status()
+    done = False
+    try:
+      for line in r.iter_lines():
+        chunk = json.loads(line)
+        if chunk.get("response"):
+          print(chunk['response'], end='', flush=True)
+        if chunk.get("done"):
+          timings = chunk["timings"]
+          done = True
+    except requests.RequestException:
+      pass
+    if not done:
+      # the service failed or was stopped partway, running the query again here would repeat the answer
+      print("\n--- answer truncated, the query service stopped before finishing ---", file=sys.stderr)
+except requests.HTTPError as ex:
+  # the service is up but could not answer, e.g. the vector store is unreachable
+  print(f"--- the query service failed: {ex} ---", file=sys.stderr)
+except requests.ConnectionError:
+  engine = QueryEngine(config)
+  engine.warm()
+  for token in engine.stream(query, timings):
+    print(token, end='', flush=True)
+  metrics.export()
 
-for chunk in stream:
-  if chunk["response"]:
-    print(chunk['response'], end='', flush=True)
+print("\n" + format_timings(timings), file=sys.stderr)
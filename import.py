@@ -1,53 +1,158 @@
-import os, ollama, chromadb, time
-from utilities import readtext, getconfig
-from tools import chunker, chunk_text_by_sentences, chunk_text_by_words
+import os, time
+from utilities import getconfig
+from embedder import getembedconfig
+from embedcache import getcache
+from writer import CollectionWriter
+from manifest import Manifest, file_hash, text_hash
+from fetcher import fetch_documents, getfetchconfig
+from bm25 import BM25Index
+from vectorstore import open_collection
+from metrics import metrics, configure_metrics
+from ingestion import IngestPipeline, extract_file, getpipelineconfig
+from semantic import set_sentence_embedder, getsemanticconfig
 
-def process_files_in_folder(folder_path, embedmodel, collection):
-    for root, _, files in os.walk(folder_path):
-        for filename in files:
+# decide if you want to use chunk by sentence or by words
+FILE_CHUNKING = {"method": "words", "words_per_chunk": 1000, "overlap": 200}
+#FILE_CHUNKING = {"method": "sentences", "sentences_per_chunk": 15, "overlap": 3}
+# or split where the topic changes, short chunks reuse their sentence embeddings (see semantic.py)
+#FILE_CHUNKING = {"method": "semantic", "percentile": 95, "buffer": 1, "min_sentences": 2, "max_sentences": 30, "pool_sentences": 8}
+WEB_CHUNKING = {"method": "sentences", "sentences_per_chunk": 7, "overlap": 3}
+
+def remove_chunks(name, manifest, writer):
+    entry = manifest.remove(name)
+    if entry and entry.get("chunks"):
+        writer.delete([name + str(index) for index in range(entry["chunks"])])
+
+def source_jobs(folder_path, writer, fetchconfig, manifest, seen):
+    """
+    Yields a job for every new or changed source in the folder, after removing its old chunks.
+    Sources recorded in the manifest are skipped, which is also how an interrupted run resumes.
+    """
+    files, web_lists = [], []
+    for root, _, names in os.walk(folder_path):
+        for filename in names:
             if filename == "read_from_webpage.txt":
-                web_path = os.path.join(root, filename)
-                with open(web_path, 'r') as f:
-                    lines = f.readlines()
-                    for filename in lines:
-                        text = readtext(filename)
-                        chunks = chunk_text_by_sentences(source_text=text, sentences_per_chunk=7, overlap=3)
-                        print(f"Processing {filename} with {len(chunks)} chunks")
-                        for index, chunk in enumerate(chunks):
-                            embed = ollama.embeddings(model=embedmodel, prompt=chunk)['embedding']
-                            print(".", end="", flush=True)
-                            collection.add([filename + str(index)], [embed], documents=[chunk], metadatas={"source": filename})
+                web_lists.append(os.path.join(root, filename))
             else:
                 filepath = os.path.join(root, filename)
-                text = readtext(filepath)
-                # decide if you want to use chunk by sentence or by words
-                chunks = chunk_text_by_words(source_text=text, words_per_chunk=1000, overlap=200)
-                #chunks = chunk_text_by_sentences(source_text=text, sentences_per_chunk=15, overlap=3)
-                print(f"Processing {filename} with {len(chunks)} chunks")
-                for index, chunk in enumerate(chunks):
-                    embed = ollama.embeddings(model=embedmodel, prompt=chunk)['embedding']
-                    print(".", end="", flush=True)
-                    collection.add([filename + str(index)], [embed], documents=[chunk], metadatas={"source": filename})
+                files.append((os.stat(filepath), filepath))
+    # largest files first so a big PDF is not the last one still being parsed
+    for stat, filepath in sorted(files, key=lambda file: file[0].st_size, reverse=True):
+        # keyed by the path within the folder, files of the same name in other subfolders are other sources
+        name = os.path.relpath(filepath, folder_path)
+        seen.add(name)
+        if manifest.is_unchanged(name, FILE_CHUNKING, size=stat.st_size, mtime=stat.st_mtime):
+            continue
+        with metrics.timer("load"):
+            hash = file_hash(filepath)
+        if manifest.is_unchanged(name, FILE_CHUNKING, hash=hash):
+            # touched but not modified, only refresh size and mtime
+            manifest.update(name, **{**manifest.get(name), "size": stat.st_size, "mtime": stat.st_mtime})
+            continue
+        remove_chunks(name, manifest, writer)
+        yield {"name": name, "path": filepath, "settings": FILE_CHUNKING,
+               "entry": {"path": filepath, "size": stat.st_size, "mtime": stat.st_mtime,
+                         "hash": hash, "settings": FILE_CHUNKING}}
+    for web_path in web_lists:
+        with open(web_path, 'r') as f:
+            lines = [line for line in f.readlines() if line.strip()]
+        seen.update(lines)
+        # fetching runs ahead of the pipeline, bounded by the fetch queue
+        for result in fetch_documents(lines, manifest, **fetchconfig, settings=WEB_CHUNKING):
+            name = result.key
+            if result.error is not None:
+                print(f"\nFailed to fetch {result.url}: {result.error}")
+                continue
+            if result.not_modified:
+                print(f"\nSkipping not modified {result.url}")
+                continue
+            hash = text_hash(result.text)
+            validators = {"etag": result.etag, "last_modified": result.last_modified}
+            if manifest.is_unchanged(name, WEB_CHUNKING, hash=hash):
+                print(f"Skipping unchanged {result.url}")
+                manifest.update(name, **{**manifest.get(name), **validators})
+                continue
+            remove_chunks(name, manifest, writer)
+            yield {"name": name, "text": result.text, "settings": WEB_CHUNKING,
+                   "entry": {"hash": hash, "settings": WEB_CHUNKING, **validators}}
+
+def process_files_in_folder(folder_path, pipeline, writer, fetchconfig, manifest, checkpoint):
+    seen = set()
+
+    def done(job, count):
+        manifest.update(job["name"], **job["entry"], chunks=count)
+
+    pipeline.run(source_jobs(folder_path, writer, fetchconfig, manifest, seen), done, checkpoint)
+    # remove vectors of sources that no longer exist
+    for name in manifest.keys():
+        if name not in seen:
+            print(f"Removing deleted {name.strip()}")
+            remove_chunks(name, manifest, writer)
 
 collectionname="python-rag-ollama"
 
-chroma = chromadb.HttpClient(host="localhost", port=8000)
-print(chroma.list_collections())
-if any(collection.name == collectionname for collection in chroma.list_collections()):
-  print('deleting collection')
-  chroma.delete_collection("python-rag-ollama")
-collection = chroma.get_or_create_collection(name="python-rag-ollama", metadata={"hnsw:space": "cosine"})
+def main():
+    config = getconfig()
+    configure_metrics(config)
+    # incremental runs only re-embed new or changed sources, full runs rebuild the collection
+    incremental = config.get("incremental", "false").lower() == "true"
+    manifest = Manifest(config.get("manifest_path", "ingest_manifest.json"))
+    bm25_path = config.get("bm25_path", "bm25.idx")
+    # a full run leaves this marker until it finishes, the next run resumes from the last checkpoint
+    running = manifest.path + ".running"
+    resume = not incremental and os.path.exists(running)
+    fresh = not incremental and not resume
+    if resume:
+        print("Resuming the interrupted import from its last checkpoint")
+    bm25 = BM25Index() if fresh else BM25Index.load(bm25_path)
+
+    collection = open_collection(config, collectionname, reset=fresh)
+    if fresh:
+        manifest.clear()
+    if not incremental:
+        open(running, 'w').close()
+
+    embedmodel = config["embedmodel"]
+    embedconfig = getembedconfig(config)
+    embedconfig["cache"] = getcache(config)
+    fetchconfig = getfetchconfig(config)
+    starttime = time.time()
+    folder_path = 'SOURCE_DOCUMENTS'
+    # Check if the directory exists
+    if not os.path.exists(folder_path):
+        # Create the directory
+        os.makedirs(folder_path)
+        print(f"Directory '{folder_path}' created.")
+
+    def checkpoint():
+        manifest.save()
+        bm25.save(bm25_path)
+
+    try:
+        # resumed and incremental runs may rewrite rows that are already stored
+        with CollectionWriter(collection, batch_size=int(config.get("store_batch_size", 500)), upsert=not fresh, index=bm25) as writer:
+            # semantic chunking embeds sentences in the extraction workers
+            pipeline = IngestPipeline(extract_file, writer, embedmodel, embedconfig, **getpipelineconfig(config),
+                                      initializer=set_sentence_embedder, initargs=(embedmodel, getsemanticconfig(config)))
+            process_files_in_folder(folder_path, pipeline, writer, fetchconfig, manifest, checkpoint)
+    finally:
+        checkpoint()
+    if not incremental:
+        os.remove(running)
+    writer.report()
+    print(f"{pipeline.sources} sources imported, {pipeline.failed} failed")
+    if metrics.enabled:
+        print(metrics.summary())
+        metrics.export()
 
-embedmodel = getconfig()["embedmodel"]
-starttime = time.time()
-folder_path = 'SOURCE_DOCUMENTS'
-# Check if the directory exists
-if not os.path.exists(folder_path):
-    # Create the directory
-    os.makedirs(folder_path)
-    print(f"Directory '{folder_path}' created.")
+    # large local collections are searched through an IVF index instead of a full scan,
+    # and optionally on compact int8 or product-quantized codes
+    if int(config.get("ivf_lists", 0)) > 0 and hasattr(collection, "build_ivf"):
+        collection.build_ivf(int(config.get("ivf_lists")))
+    if config.get("vector_codes", "none") != "none" and hasattr(collection, "build_codes"):
+        collection.build_codes(config["vector_codes"], int(config.get("pq_m", 16)))
 
-process_files_in_folder(folder_path, embedmodel, collection)
+    print("--- %s seconds ---" % (time.time() - starttime))
 
 # with open('sourcedocs.txt') as f:
 #   lines = f.readlines()
@@ -59,6 +164,7 @@ process_files_in_folder(folder_path, embedmodel, collection)
 #       embed = ollama.embeddings(model=embedmodel, prompt=chunk)['embedding']
 #       print(".", end="", flush=True)
 #       collection.add([filename+str(index)], [embed], documents=[chunk], metadatas={"source": filename})
-    
-print("--- %s seconds ---" % (time.time() - starttime))
 
+# extraction runs in worker processes, which import this file again on platforms that spawn them
+if __name__ == "__main__":
+    main()
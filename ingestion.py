@@ -0,0 +1,234 @@
+import os, time, queue, multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from embedder import embed_chunks, embed_batch
+from metrics import metrics
+from semantic import semantic_chunks, sentence_embedder
+from tools import iter_chunks_stream
+from utilities import iter_text
+
+def extract_file(job):
+    """
+    Extracts and chunks one source. Runs in a worker process.
+    job holds the name, the chunker settings and either a file path or the fetched text.
+    Chunks are produced page by page as the text is extracted. Semantic chunks need the whole
+    text and come with their pooled embedding, or None where they still need one.
+    Returns:
+      generator of (chunk, metadata) or (chunk, metadata, embedding)
+    """
+    if job["settings"]["method"] == "semantic":
+        text = job["text"] if "text" in job else "".join(metrics.timed("extract", iter_text(job["path"])))
+        for chunk, start, end, embedding in semantic_chunks(text, sentence_embedder(), job["settings"]):
+            yield chunk, {"source": job["name"], "start": start, "end": end}, embedding
+        return
+    segments = [job["text"]] if "text" in job else metrics.timed("extract", iter_text(job["path"]))
+    for chunk, start, end in metrics.timed("chunk", iter_chunks_stream(segments, job["settings"])):
+        yield chunk, {"source": job["name"], "start": start, "end": end}
+
+# the queue worker processes send their chunks through, set up when each worker starts
+_pieces = None
+
+def init_extract_worker(pieces, metrics_format, initializer, initargs):
+    global _pieces
+    _pieces = pieces
+    # timers stay no-ops in the workers unless the main process records metrics
+    metrics.configure(metrics_format)
+    if initializer is not None:
+        initializer(*initargs)
+
+def run_extract(extract, job_id, job, piece_chunks):
+    """
+    Runs extract for one job in a worker process and sends its chunks to the main process
+    in pieces of at most piece_chunks as they are produced, so embedding starts on the first
+    pages of a large file while the rest is still being parsed. A final message carries the
+    chunk count, the stage times and the error if there was one.
+    Chunks before the job's resume_from were stored by an earlier run and are not sent.
+    """
+    # each worker process has its own copy of the metrics, so the stage times go back with the result
+    if metrics.enabled:
+        metrics.histograms = {}
+    first = job.get("resume_from", 0)
+    piece, start, count, error = [], first, 0, None
+    try:
+        for chunk in extract(job):
+            if count >= first:
+                piece.append(chunk)
+                if len(piece) >= piece_chunks:
+                    _pieces.put(("chunks", job_id, start, piece))
+                    start, piece = start + len(piece), []
+            count += 1
+        if piece:
+            _pieces.put(("chunks", job_id, start, piece))
+    except Exception as ex:
+        error = str(ex)
+    timings = {stage: histogram.sum for stage, histogram in metrics.histograms.items()}
+    _pieces.put(("done", job_id, count, timings, error))
+
+def default_chunk_id(job, index, metadata):
+    return job["name"] + str(index)
+
+class IngestPipeline:
+    """
+    Streams sources through extract -> chunk -> embed -> store.
+    Extraction and chunking run in worker processes on at most extract_queue sources at a time.
+    Their chunks come back through a queue of at most extract_queue pieces of piece_chunks
+    chunks each, taken in the order they are produced, so a large file does not hold up
+    the ones after it. Embedding runs on embed_chunks' thread pool with a bounded number of
+    batches in flight, and rows are written in batches by the CollectionWriter. A full stage
+    stalls the one before it, so memory stays bounded however large the corpus or its files are.
+    A source is reported done only once all of its rows have been written, and on_checkpoint
+    is called at most every checkpoint_interval seconds when sources complete, so an
+    interrupted run can resume from the last checkpoint.
+    Chunks extracted together with an embedding are stored without another embedding call.
+    """
+    def __init__(self, extract, writer, embedmodel, embedconfig, processes=None, extract_queue=8,
+                 checkpoint_interval=30.0, chunk_id=default_chunk_id, initializer=None, initargs=(),
+                 piece_chunks=32):
+        self.extract = extract
+        self.writer = writer
+        self.embedmodel = embedmodel
+        self.embedconfig = embedconfig
+        self.processes = processes or os.cpu_count() or 4
+        self.extract_queue = extract_queue
+        self.piece_chunks = piece_chunks
+        self.checkpoint_interval = checkpoint_interval
+        self.chunk_id = chunk_id
+        self.initializer = initializer
+        self.initargs = initargs
+        self.sources = 0
+        self.failed = 0
+
+    def _extracted(self, pool, jobs):
+        # yields (job, index, chunk, metadata, embedding) as pieces arrive, and
+        # (job, chunk_count, None, None, None) once every chunk of a source has been yielded
+        jobs = iter(jobs)
+        next_id = 0
+        exhausted = False
+        while True:
+            while not exhausted and len(self.running) < self.extract_queue:
+                job = next(jobs, None)
+                if job is None:
+                    exhausted = True
+                    break
+                self.running[next_id] = (job, pool.submit(run_extract, self.extract, next_id, job, self.piece_chunks))
+                next_id += 1
+            if not self.running:
+                return
+            try:
+                message = self.pieces.get(timeout=1.0)
+            except queue.Empty:
+                # a worker that died never sends its final message
+                for job_id, (job, future) in list(self.running.items()):
+                    if future.done() and future.exception() is not None:
+                        del self.running[job_id]
+                        self._failed(job, future.exception())
+                continue
+            if message[1] not in self.running:
+                continue
+            job = self.running[message[1]][0]
+            if message[0] == "chunks":
+                _, _, start, piece = message
+                for offset, (chunk, metadata, *embedding) in enumerate(piece):
+                    yield job, start + offset, chunk, metadata, embedding[0] if embedding else None
+                continue
+            _, job_id, count, timings, error = message
+            del self.running[job_id]
+            for stage, seconds in timings.items():
+                metrics.observe(stage, seconds)
+            if error is not None:
+                self._failed(job, error)
+                continue
+            first = min(job.get("resume_from", 0), count)
+            print(f"Processed {job['name']}: {count} chunks" + (f", {first} already stored" if first else ""))
+            yield job, count, None, None, None
+
+    def _failed(self, job, error):
+        # not reported done, so the next run tries it again; rows already written are
+        # overwritten then, as chunk ids are the same for the same source
+        print(f"\nFailed to process {job['name']}: {error}")
+        self.failed += 1
+
+    def _stop(self):
+        # workers may be blocked on a full queue if embedding stopped early
+        for _, future in self.running.values():
+            future.cancel()
+        while not all(future.done() for _, future in self.running.values()):
+            try:
+                self.pieces.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def _embed(self, items, embed):
+        # only the chunks that did not bring an embedding along are sent to the model
+        needed = [item[2] is not None and item[4] is None for item in items]
+        texts = [item[2] for item, need in zip(items, needed) if need]
+        if not texts:
+            fresh = iter([])
+        elif embed is not None:
+            fresh = iter(embed(texts))
+        else:
+            fresh = iter(embed_batch(texts, self.embedmodel, self.embedconfig.get("retries", 3),
+                                     self.embedconfig.get("backoff", 1.0), self.embedconfig.get("cache")))
+        return [next(fresh) if need else item[4] for item, need in zip(items, needed)]
+
+    def _complete(self, on_done, on_checkpoint, on_stored, force=False):
+        # a row is durable once the writer has flushed every row added up to it
+        stored = {}
+        while self.inflight and self.writer.rows >= self.inflight[0][0]:
+            _, job, index = self.inflight.popleft()
+            stored[job["name"]] = (job, index + 1)
+        if on_stored:
+            for job, count in stored.values():
+                on_stored(job, count)
+        completed = False
+        while self.waiting and self.writer.rows >= self.waiting[0][2]:
+            job, count, _ = self.waiting.popleft()
+            on_done(job, count)
+            self.sources += 1
+            completed = True
+        if on_checkpoint and (force or (completed or stored) and time.time() - self.last_checkpoint >= self.checkpoint_interval):
+            on_checkpoint()
+            self.last_checkpoint = time.time()
+
+    def run(self, jobs, on_done, on_checkpoint=None, embed=None, on_stored=None):
+        """
+        jobs are dicts with at least a name and whatever extract needs, they may be produced lazily.
+        A job's resume_from skips that many leading chunks.
+        on_done(job, chunk_count) is called for each source after its rows are written, and
+        on_stored(job, count) after each write with how many leading chunks of the source are stored.
+        embed, if given, replaces the ollama embedding call, as in embed_chunks.
+        """
+        self.waiting = deque()
+        self.inflight = deque()
+        self.running = {}
+        self.added = self.writer.rows + len(self.writer.ids)
+        self.last_checkpoint = time.time()
+        self.pieces = multiprocessing.Queue(self.extract_queue)
+        with ProcessPoolExecutor(self.processes, initializer=init_extract_worker,
+                                 initargs=(self.pieces, metrics.format if metrics.enabled else "none",
+                                           self.initializer, self.initargs)) as pool:
+            try:
+                chunks = self._extracted(pool, jobs)
+                for (job, index, chunk, metadata, _), embedding in embed_chunks(
+                        chunks, self.embedmodel, self.embedconfig.get("batch_size", 32), self.embedconfig.get("workers", 4),
+                        embed=lambda items: self._embed(items, embed)):
+                    if chunk is None:
+                        # every chunk of the source has been added, it is done once they are written
+                        self.waiting.append((job, index, self.added))
+                    else:
+                        self.writer.add(self.chunk_id(job, index, metadata), embedding, chunk, metadata)
+                        self.added += 1
+                        self.inflight.append((self.added, job, index))
+                    self._complete(on_done, on_checkpoint, on_stored)
+            finally:
+                self._stop()
+        self.writer.flush()
+        self._complete(on_done, on_checkpoint, on_stored, force=True)
+
+def getpipelineconfig(config):
+    return {
+        "processes": int(config.get("extract_processes", 0)) or None,
+        "extract_queue": int(config.get("extract_queue", 8)),
+        "piece_chunks": int(config.get("extract_piece_chunks", 32)),
+        "checkpoint_interval": float(config.get("checkpoint_interval", 30)),
+    }
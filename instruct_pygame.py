@@ -1,6 +1,8 @@
 import pygame
 import ollama
+import queue
 import threading
+from streaming import chat_tokens
 
 pygame.init()
 font = pygame.font.Font('freesansbold.ttf', 24)
@@ -21,30 +23,135 @@ def format_history(msg: str, history: list[list[str, str]], system_prompt: str):
 def generate_response(msg: str, history: list[list[str, str]], system_prompt: str):
     chat_history = format_history(msg, history, system_prompt)
     response = ollama.chat(model='llama2', stream=True, messages=chat_history)
-    message = ""
-    for partial_resp in response:
-        token = partial_resp["message"]["content"]
-        message += token
-        yield message
+    yield from chat_tokens(response)
+
+# Reads the response stream off the main loop
+class TokenPump:
+    """
+    A producer thread drains the stream into a queue and the main loop takes whatever
+    has arrived once per frame, so frames never wait on the network and tokens are not
+    limited to one per frame. Starting a new stream cancels the one in flight.
+    """
+    def __init__(self):
+        self.tokens = queue.SimpleQueue()
+        self.stream_id = 0
+        self.running = False
+
+    def start(self, make_stream):
+        self.stream_id += 1
+        self.running = True
+        threading.Thread(target=self._run, args=(self.stream_id, make_stream), daemon=True).start()
+
+    def cancel(self):
+        self.stream_id += 1
+        self.running = False
+
+    def _run(self, stream_id, make_stream):
+        stream = make_stream()
+        try:
+            for token in stream:
+                if stream_id != self.stream_id:
+                    break
+                self.tokens.put((stream_id, token))
+        finally:
+            # closing the generator closes the HTTP response of a cancelled stream
+            stream.close()
+            self.tokens.put((stream_id, None))
+
+    def drain(self):
+        """
+        Returns the text that arrived for the current stream since the last call
+        """
+        parts = []
+        while True:
+            try:
+                stream_id, token = self.tokens.get_nowait()
+            except queue.Empty:
+                break
+            if stream_id != self.stream_id:
+                continue  # left over from a cancelled stream
+            if token is None:
+                self.running = False
+            else:
+                parts.append(token)
+        return "".join(parts)
 
 # Function to wrap text within a given width
-def wrap_text(text, font, max_width):
-    words = text.split(' ')
+def wrap_text(text, font, max_width, widths=None):
+    """
+    Greedy word wrap. Line widths are summed from cached word widths instead of
+    measuring the re-joined line after every word.
+    """
+    widths = {} if widths is None else widths
+    space = font.size(' ')[0]
     lines = []
     current_line = []
-    width, height = font.size('')
+    width = 0
 
-    for word in words:
-        current_line.append(word)
-        width, height = font.size(' '.join(current_line))
-        if width > max_width:
-            current_line.pop()
+    for word in text.split(' '):
+        if word not in widths:
+            widths[word] = font.size(word)[0]
+        new_width = width + space + widths[word] if current_line else widths[word]
+        if current_line and new_width > max_width:
             lines.append(' '.join(current_line))
             current_line = [word]
+            width = widths[word]
+        else:
+            current_line.append(word)
+            width = new_width
 
     lines.append(' '.join(current_line))
     return lines
 
+# Wrapped text that grows at the end, as a streamed answer does
+class TextLayout:
+    """
+    Appending text only re-wraps the last line: with greedy wrapping the lines before it
+    cannot change. Each line keeps its rendered surface until it changes, and only the
+    lines inside the output box are drawn.
+    """
+    def __init__(self, font, max_width, color='white', spacing=5):
+        self.font = font
+        self.max_width = max_width
+        self.color = color
+        self.line_height = font.get_linesize() + spacing
+        self.clear()
+
+    def clear(self):
+        self.lines = [""]
+        self.surfaces = [None]
+        self.widths = {}
+
+    def append(self, text):
+        parts = text.split('\n')
+        self._extend(parts[0])
+        for part in parts[1:]:
+            self.lines.append("")
+            self.surfaces.append(None)
+            self._extend(part)
+
+    def _extend(self, text):
+        if not text:
+            return
+        wrapped = wrap_text(self.lines[-1] + text, self.font, self.max_width, self.widths)
+        self.lines[-1:] = wrapped
+        self.surfaces[-1:] = [None] * len(wrapped)
+
+    def height(self):
+        return len(self.lines) * self.line_height
+
+    def draw(self, screen, rect, scroll_offset, padding=10):
+        top = rect.y + padding + scroll_offset
+        first = max(0, (rect.y - top) // self.line_height)
+        last = min(len(self.lines), (rect.bottom - top) // self.line_height + 1)
+        previous_clip = screen.get_clip()
+        screen.set_clip(rect)
+        for i in range(first, last):
+            if self.surfaces[i] is None:
+                self.surfaces[i] = self.font.render(self.lines[i], True, self.color)
+            screen.blit(self.surfaces[i], (rect.x + padding, top + i * self.line_height))
+        screen.set_clip(previous_clip)
+
 # Pygame input box class
 class InputBox:
     def __init__(self, x, y, w, h, text=''):
@@ -107,22 +214,19 @@ class InputBox:
 
 # Initialize variables
 input_box = InputBox(10, 10, 780, 50)
-message = ""
-snip = font.render("", True, "white")
-response_generator = None
-response_text = ""
-new_response = False
-output_lines = []
+pump = TokenPump()
 output_box_rect = pygame.Rect(10, 100, 780, 380)
+layout = TextLayout(font, output_box_rect.width - 20)
 scroll_offset = 0
 scroll_speed = 10
 
 def fetch_response(text):
-    global response_generator, new_response
+    global scroll_offset
     history = []  # you can update this with actual chat history if needed
     system_prompt = "Provide the answer clearly, in a short succinct way"  # Update with your system prompt
-    response_generator = generate_response(text, history, system_prompt)
-    new_response = True
+    layout.clear()
+    scroll_offset = 0
+    pump.start(lambda: generate_response(text, history, system_prompt))
 
 # Main game loop
 run = True
@@ -137,7 +241,7 @@ while run:
 
         result = input_box.handle_event(event)
         if result is not None:
-            threading.Thread(target=fetch_response, args=(result,)).start()
+            fetch_response(result)
 
         # Scroll with the mouse wheel
         if event.type == pygame.MOUSEWHEEL:
@@ -146,21 +250,17 @@ while run:
     input_box.update()
     input_box.draw(screen)
 
-    if new_response:
-        try:
-            message = next(response_generator)
-            output_lines = wrap_text(message, font, output_box_rect.width - 20)
-        except StopIteration:
-            new_response = False
+    arrived = pump.drain()
+    if arrived:
+        layout.append(arrived)
 
-    y_offset = output_box_rect.y + 10
-    for line in output_lines:
-        snip = font.render(line, True, 'white')
-        screen.blit(snip, (output_box_rect.x + 10, y_offset))
-        y_offset += snip.get_height() + 5
+    # keep the text from scrolling past its first or last line
+    scroll_offset = max(min(scroll_offset, 0), min(0, output_box_rect.height - 20 - layout.height()))
+    layout.draw(screen, output_box_rect, scroll_offset)
 
     pygame.display.flip()
 
+pump.cancel()
 pygame.quit()
 
 # message = "This is a message"
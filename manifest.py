@@ -0,0 +1,59 @@
+import os, json, hashlib
+
+def file_hash(path, blocksize=1 << 20):
+    """
+    Returns the sha256 of a file, read in blocks
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(blocksize):
+            h.update(block)
+    return h.hexdigest()
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8', errors='ignore')).hexdigest()
+
+class Manifest:
+    """
+    Records what has been ingested for each source so unchanged sources can be skipped.
+    Each entry holds size, mtime, content hash, chunker settings and the number of chunks stored.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+
+    def clear(self):
+        self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def is_unchanged(self, key, settings, size=None, mtime=None, hash=None):
+        """
+        A source is unchanged if its chunker settings match and either its size and mtime
+        or its content hash match what was recorded
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry.get("settings") != settings:
+            return False
+        if hash is not None:
+            return entry.get("hash") == hash
+        return entry.get("size") == size and entry.get("mtime") == mtime
+
+    def update(self, key, **entry):
+        self.entries[key] = entry
+
+    def remove(self, key):
+        return self.entries.pop(key, None)
+
+    def keys(self):
+        return list(self.entries.keys())
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp, self.path)
@@ -0,0 +1,171 @@
+import json, time, bisect, threading
+from contextlib import contextmanager
+
+# upper bounds in seconds, doubling from 0.5ms to about a minute
+BUCKETS = [0.0005 * 2 ** i for i in range(18)]
+
+# nanosecond durations reported on the last chunk of an ollama generate/chat stream
+SERVER_DURATIONS = {"prompt_eval": "prompt_eval_duration", "eval": "eval_duration", "load": "load_duration"}
+SERVER_COUNTS = {"prompt_eval": "prompt_eval_count", "eval": "eval_count"}
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + [float("inf")], self.counts):
+            seen += count
+            if seen >= rank:
+                return bound if bound != float("inf") else BUCKETS[-1]
+        return BUCKETS[-1]
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_TIMER = _NullTimer()
+
+class Metrics:
+    """
+    Per-stage latency histograms and token counters for ingestion, retrieval and generation.
+    Nested timers record self time, so a chunker timed while it pulls text from a timed
+    extractor does not count the extraction twice.
+    Disabled until configure() is called; a disabled timer is a shared no-op object.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.format = "prometheus"
+        self.path = None
+        self.histograms = {}
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def configure(self, format="prometheus", path=None):
+        self.enabled = format not in (None, "", "none", "off")
+        self.format = format
+        self.path = path
+        return self
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, stage):
+        if not self.enabled:
+            return NULL_TIMER
+        return self._timer(stage)
+
+    @contextmanager
+    def _timer(self, stage):
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.observe(stage, elapsed - children)
+
+    def timed(self, stage, iterable):
+        """
+        Yields from iterable, timing each step as stage
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            with self._timer(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def observe_server(self, chunk):
+        """
+        Records the durations and token counts the server reports on the final chunk
+        """
+        if not self.enabled or not chunk:
+            return
+        for stage, key in SERVER_DURATIONS.items():
+            if chunk.get(key):
+                self.observe(stage, chunk[key] / 1000000000)
+        with self.lock:
+            for kind, key in SERVER_COUNTS.items():
+                if chunk.get(key):
+                    self.tokens[kind] = self.tokens.get(kind, 0) + chunk[key]
+
+    def prometheus(self):
+        lines = ["# TYPE rag_stage_seconds histogram"]
+        with self.lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f'rag_stage_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {cumulative}')
+                lines.append(f'rag_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'rag_stage_seconds_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+                lines.append(f'rag_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            lines.append("# TYPE rag_server_tokens_total counter")
+            for kind, count in sorted(self.tokens.items()):
+                lines.append(f'rag_server_tokens_total{{kind="{kind}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def json_lines(self):
+        now = time.time()
+        with self.lock:
+            lines = [json.dumps({"time": now, "stage": stage, "count": h.count, "sum": round(h.sum, 6),
+                                 "p50": h.quantile(0.5), "p99": h.quantile(0.99)})
+                     for stage, h in sorted(self.histograms.items())]
+            lines += [json.dumps({"time": now, "tokens": kind, "count": count}) for kind, count in sorted(self.tokens.items())]
+        return "".join(line + "\n" for line in lines)
+
+    def export(self):
+        """
+        Writes the metrics to the configured path, replacing a Prometheus file and
+        appending to a JSON lines file
+        """
+        if not self.enabled or not self.path:
+            return
+        if self.format == "jsonl":
+            with open(self.path, "a") as f:
+                f.write(self.json_lines())
+        else:
+            with open(self.path, "w") as f:
+                f.write(self.prometheus())
+
+    def summary(self):
+        with self.lock:
+            return ", ".join(f"{stage} p50 {h.quantile(0.5) * 1000:.1f}ms p99 {h.quantile(0.99) * 1000:.1f}ms x{h.count}"
+                             for stage, h in sorted(self.histograms.items()))
+
+# shared by every module of one process
+metrics = Metrics()
+
+def configure_metrics(config):
+    return metrics.configure(config.get("metrics", "none"), config.get("metrics_path", "metrics.prom"))
@@ -0,0 +1,100 @@
+import numpy as np
+
+BLOCK = 65536
+
+def kmeans(data, k, iterations=10, seed=0):
+    """
+    Plain k-means on the rows of data. Returns:
+      (centroids, assignment)
+    """
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), min(k, len(data)), replace=False)].copy()
+    for _ in range(iterations):
+        # squared distances without materializing the difference tensor
+        distances = (data ** 2).sum(1)[:, None] - 2 * data @ centroids.T + (centroids ** 2).sum(1)[None, :]
+        assignment = np.argmin(distances, axis=1)
+        for i in range(len(centroids)):
+            members = data[assignment == i]
+            if len(members):
+                centroids[i] = members.mean(axis=0)
+    return centroids, assignment
+
+class Int8Codes:
+    """
+    Scalar quantization to one byte per dimension, using the per-dimension range of the training vectors
+    """
+    kind = "int8"
+
+    def fit(self, sample):
+        self.low = sample.min(axis=0).astype(np.float32)
+        self.scale = np.maximum((sample.max(axis=0) - self.low) / 255, 1e-12).astype(np.float32)
+        return self
+
+    def encode(self, vectors):
+        return np.clip(np.rint((vectors - self.low) / self.scale), 0, 255).astype(np.uint8)
+
+    def scores(self, query, codes):
+        # q . (low + code * scale) = q . low + (q * scale) . code
+        weights = query * self.scale
+        offset = float(query @ self.low)
+        return np.concatenate([codes[i:i + BLOCK].astype(np.float32) @ weights + offset
+                               for i in range(0, len(codes), BLOCK)] or [np.zeros(0, np.float32)])
+
+    def params(self):
+        return {"low": self.low, "scale": self.scale}
+
+    def load(self, params):
+        self.low, self.scale = params["low"], params["scale"]
+        return self
+
+class PQCodes:
+    """
+    Product quantization: the vector is split into m sub-vectors and each is replaced by the
+    id of its nearest of 256 centroids, so a vector takes m bytes
+    """
+    kind = "pq"
+
+    def __init__(self, m=16):
+        self.m = m
+
+    def fit(self, sample):
+        dim = sample.shape[1]
+        self.m = max(1, min(self.m, dim))
+        self.bounds = np.linspace(0, dim, self.m + 1).astype(int)
+        self.codebooks = [kmeans(sample[:, lo:hi], 256)[0].astype(np.float32)
+                          for lo, hi in zip(self.bounds[:-1], self.bounds[1:])]
+        return self
+
+    def encode(self, vectors):
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for j, (lo, hi) in enumerate(zip(self.bounds[:-1], self.bounds[1:])):
+            part, book = vectors[:, lo:hi], self.codebooks[j]
+            distances = -2 * part @ book.T + (book ** 2).sum(1)[None, :]
+            codes[:, j] = np.argmin(distances, axis=1)
+        return codes
+
+    def scores(self, query, codes):
+        # one lookup table of partial dot products per sub-vector
+        tables = [book @ query[lo:hi] for book, lo, hi in zip(self.codebooks, self.bounds[:-1], self.bounds[1:])]
+        scores = np.zeros(len(codes), dtype=np.float32)
+        for j, table in enumerate(tables):
+            scores += table[codes[:, j]]
+        return scores
+
+    def params(self):
+        params = {"bounds": self.bounds}
+        params.update({f"codebook{j}": book for j, book in enumerate(self.codebooks)})
+        return params
+
+    def load(self, params):
+        self.bounds = params["bounds"]
+        self.m = len(self.bounds) - 1
+        self.codebooks = [params[f"codebook{j}"] for j in range(self.m)]
+        return self
+
+def make_quantizer(kind, pq_m=16):
+    if kind == "int8":
+        return Int8Codes()
+    if kind == "pq":
+        return PQCodes(pq_m)
+    raise ValueError(f"Unknown vector code type: {kind}")
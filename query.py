@@ -0,0 +1,204 @@
+import os, json, time, threading, ollama
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from embedder import embed_batch
+from embedcache import getcache, LRUCache
+from context import assemble_context
+from bm25 import BM25Index, fuse
+from vectorstore import open_collection
+from metrics import metrics
+
+class QueryEngine:
+    """
+    Answers questions against the python-rag-ollama collection.
+    Keeps the Chroma client and the main model warm between queries and caches
+    query embeddings and retrieval results.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.embedmodel = config["embedmodel"]
+        self.mainmodel = config["mainmodel"]
+        self.n_results = int(config.get("n_results", 10))
+        self.context_tokens = int(config.get("context_tokens", 2048))
+        self.keep_alive = config.get("keep_alive", "30m")
+        self.embed_cache = getcache(config)
+        self.query_embeddings = LRUCache(int(config.get("query_cache_size", 256)))
+        # retrieval results go stale when the collection is re-imported, so they expire
+        self.retrievals = LRUCache(int(config.get("query_cache_size", 256)), float(config.get("retrieval_cache_ttl", 300)))
+        self.bm25_path = config.get("bm25_path", "bm25.idx")
+        self.bm25_mtime = None
+        self.index_lock = threading.Lock()
+        self.refresh_index()
+        self.lexical_ratio = float(config.get("lexical_fast_path_ratio", 2.0))
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        # connect to the vector store while the first query is being embedded
+        self.collection_future = self.executor.submit(self.connect)
+
+    def refresh_index(self):
+        """
+        Reloads the BM25 index when an import has rewritten it, and drops the retrievals
+        made against the old one
+        """
+        mtime = os.stat(self.bm25_path).st_mtime_ns if os.path.exists(self.bm25_path) else None
+        if mtime == self.bm25_mtime and hasattr(self, "bm25"):
+            return
+        with self.index_lock:
+            if mtime != self.bm25_mtime or not hasattr(self, "bm25"):
+                self.bm25 = BM25Index.load(self.bm25_path)
+                self.bm25_mtime = mtime
+                self.retrievals.clear()
+
+    def connect(self):
+        return open_collection(self.config)
+
+    @property
+    def collection(self):
+        return self.collection_future.result()
+
+    def warm(self):
+        """
+        Loads the main model without generating, so the first answer does not pay the load time
+        """
+        return self.executor.submit(ollama.generate, model=self.mainmodel, prompt="", keep_alive=self.keep_alive)
+
+    def embed(self, query):
+        embedding = self.query_embeddings.get(query)
+        if embedding is None:
+            embedding = embed_batch([query], self.embedmodel, cache=self.embed_cache)[0]
+            self.query_embeddings.put(query, embedding)
+        return embedding
+
+    def retrieve_hybrid(self, query, timings):
+        """
+        Fuses BM25 and vector rankings. When the lexical match is confident the
+        embedding call and vector search are skipped.
+        Returns:
+          list of passage dicts with text, fused score and metadata
+        """
+        start = time.perf_counter()
+        lexical = self.bm25.search(query, self.n_results)
+        timings["lexical"] = time.perf_counter() - start
+        lexical_ids = [doc_id for doc_id, _ in lexical]
+        found = {}
+        vector_ids = []
+        confident = self.bm25.confident(query, lexical, self.lexical_ratio)
+        queryembed = None
+        start = time.perf_counter()
+        if not confident:
+            queryembed = self.embed(query)
+        timings["embed"] = time.perf_counter() - start
+        start = time.perf_counter()
+        if not confident:
+            results = self.collection.query(query_embeddings=[queryembed], n_results=self.n_results,
+                                            include=["documents", "metadatas"])
+            vector_ids = results["ids"][0]
+            found = dict(zip(vector_ids, zip(results["documents"][0], results["metadatas"][0])))
+        missing = [doc_id for doc_id in lexical_ids if doc_id not in found]
+        if missing:
+            results = self.collection.get(ids=missing, include=["documents", "metadatas"])
+            found.update(zip(results["ids"], zip(results["documents"], results["metadatas"])))
+        timings["retrieve"] = time.perf_counter() - start
+        scores = fuse(lexical_ids, vector_ids)
+        return [{"text": found[doc_id][0], "score": score, **(found[doc_id][1] or {})}
+                for doc_id, score in scores.items() if doc_id in found]
+
+    def retrieve(self, query, timings):
+        self.refresh_index()
+        key = (query, self.n_results)
+        docs = self.retrievals.get(key)
+        if docs is None:
+            passages = self.retrieve_hybrid(query, timings)
+            start = time.perf_counter()
+            docs = assemble_context(passages, self.context_tokens)
+            timings["assemble"] = time.perf_counter() - start
+            self.retrievals.put(key, docs)
+        else:
+            timings["lexical"] = timings["embed"] = timings["retrieve"] = timings["assemble"] = 0.0
+        return docs
+
+    def prompt(self, query, docs):
+        docs = "\n\n".join(docs)
+        return f"{query} - Answer that question using the following text as a resource: {docs}"
+
+    def stream(self, query, timings):
+        """
+        Yields the answer token by token and fills timings with seconds per stage,
+        time to first token and tokens per second
+        """
+        start = time.perf_counter()
+        modelquery = self.prompt(query, self.retrieve(query, timings))
+        generate_start = time.perf_counter()
+        stream = ollama.generate(model=self.mainmodel, prompt=modelquery, stream=True, keep_alive=self.keep_alive)
+        for chunk in stream:
+            if chunk["response"]:
+                if "ttft" not in timings:
+                    timings["ttft"] = time.perf_counter() - start
+                yield chunk["response"]
+            if chunk.get("done"):
+                if chunk.get("eval_duration"):
+                    timings["tokens_per_second"] = chunk["eval_count"] / (chunk["eval_duration"] / 1000000000)
+                if chunk.get("prompt_eval_duration"):
+                    timings["prompt_eval"] = chunk["prompt_eval_duration"] / 1000000000
+                metrics.observe_server(chunk)
+        timings["generate"] = time.perf_counter() - generate_start
+        timings["total"] = time.perf_counter() - start
+        # the embedding request itself is timed in embed_batch
+        for stage in ("lexical", "retrieve", "assemble", "ttft", "total"):
+            if stage in timings:
+                metrics.observe(stage, timings[stage])
+
+def format_timings(timings):
+    parts = [f"{stage} {timings[stage] * 1000:.0f}ms" for stage in ("lexical", "embed", "retrieve", "assemble", "ttft", "total") if stage in timings]
+    if "tokens_per_second" in timings:
+        parts.append(f"{timings['tokens_per_second']:.2f} tokens/s")
+    return "--- " + ", ".join(parts) + " ---"
+
+def serve(engine, port=8765):
+    """
+    Serves queries over HTTP on localhost. POST /query with {"query": "..."} streams
+    newline-delimited JSON: {"response": token} lines followed by {"done": true, "timings": {...}}
+    GET /metrics returns the stage histograms in Prometheus text format.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != "/query":
+                self.send_error(404)
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            timings = {}
+            tokens = engine.stream(body.get("query", ""), timings)
+            # retrieval runs before the first token, so its errors can still be sent as a status
+            try:
+                first = next(tokens, None)
+            except Exception as ex:
+                self.send_error(500, str(ex).splitlines()[0] if str(ex) else type(ex).__name__)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            if first is not None:
+                self.wfile.write((json.dumps({"response": first}) + "\n").encode())
+                self.wfile.flush()
+            for token in tokens:
+                self.wfile.write((json.dumps({"response": token}) + "\n").encode())
+                self.wfile.flush()
+            self.wfile.write((json.dumps({"done": True, "timings": timings}) + "\n").encode())
+
+        def log_message(self, format, *args):
+            pass
+
+    engine.warm()
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    print(f"Query service listening on http://127.0.0.1:{port}/query")
+    server.serve_forever()
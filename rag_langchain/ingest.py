@@ -1,8 +1,9 @@
 import os
+import sys
 import logging
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener
 
-from langchain_experimental.text_splitter import SemanticChunker
 from langchain_text_splitters import RecursiveCharacterTextSplitter, Language
 
 from langchain.docstore.document import Document
@@ -21,6 +22,31 @@ SOURCE_DIRECTORY = os.path.join(ROOT_DIRECTORY, "SOURCE_DOCUMENTS")
 
 PERSIST_DIRECTORY = os.path.join(ROOT_DIRECTORY, "DB")
 
+# Shared helpers such as the embedding cache live in the parent directory
+sys.path.append(os.path.dirname(ROOT_DIRECTORY))
+from embedcache import EmbeddingCache, CachedEmbeddings
+from bm25 import BM25Index
+from metrics import metrics
+from writer import CollectionWriter
+from ingestion import IngestPipeline
+from manifest import Manifest
+from semantic import semantic_chunks, sentence_embedder, set_sentence_embedder
+
+EMBEDDING_MODEL_NAME = "nomic-embed-text"
+EMBED_CACHE_PATH = os.path.join(ROOT_DIRECTORY, "embed_cache.sqlite")
+BM25_PATH = os.path.join(ROOT_DIRECTORY, "bm25.idx")
+
+# Progress per source file: size, mtime, chunking settings and how many of its chunks are stored.
+# With RESUME a rerun skips files and chunks that are already stored and stores files again
+# whose chunking changed, set it to False to clear the database and ingest everything again
+MANIFEST_PATH = os.path.join(ROOT_DIRECTORY, "ingest_manifest.json")
+RESUME = True
+CHECKPOINT_INTERVAL = 10
+
+# Stage timings, set to "prometheus" or "jsonl" to write them to METRICS_PATH after each run
+METRICS_FORMAT = "none"
+METRICS_PATH = os.path.join(ROOT_DIRECTORY, "metrics.prom")
+
 # Get a list of all child directories in PERSIST_DIRECTORY
 # Check if the folder exists
 if not os.path.exists(PERSIST_DIRECTORY):
@@ -44,14 +70,47 @@ DOCUMENT_MAP = {
 # Can be changed to a specific number
 INGEST_THREADS = os.cpu_count() or 8
 
+# Pipeline bounds: files loaded at a time (their chunks come back in pieces as each one
+# is split, whichever file finishes first), texts per embedding call and concurrent calls,
+# rows per write to Chroma
+LOAD_QUEUE = 2 * INGEST_THREADS
+EMBED_BATCH_SIZE = 32
+EMBED_WORKERS = 4
+STORE_BATCH_SIZE = 500
+
+# "recursive" splits on characters, "semantic" splits where the topic changes between sentences.
+# Semantic chunking embeds the sentences in batches of SENTENCE_BATCH_SIZE through the cache, and
+# chunks of up to pool_sentences sentences store the pooled sentence vectors instead of being
+# embedded again. Python files are always split recursively.
+CHUNKING = "recursive"
+SEMANTIC_CHUNKING = {"percentile": 95, "buffer": 1, "min_sentences": 2, "max_sentences": 30, "pool_sentences": 8}
+SENTENCE_BATCH_SIZE = 256
+
 # DEVICE_TYPE = "cuda" if torch.cuda.is_available() else "cpu"
 device_type = "cpu"
 
+file_logger = logging.getLogger("file_ingest")
+
 def file_log(logentry):
-    file1 = open("file_ingest.log", "a")
-    file1.write(logentry + "\n")
-    file1.close()
-    print(logentry + "\n")
+    file_logger.info(logentry)
+
+def set_log_queue(log_queue):
+    # Runs in every loader process so all entries go through the one listener in the main process
+    file_logger.handlers = [QueueHandler(log_queue)]
+    file_logger.setLevel(logging.INFO)
+    file_logger.propagate = False
+
+def init_worker(log_queue):
+    set_log_queue(log_queue)
+    set_sentence_embedder(EMBEDDING_MODEL_NAME, {"batch_size": SENTENCE_BATCH_SIZE, "workers": 2, "cache_path": EMBED_CACHE_PATH})
+
+def start_file_log(log_queue):
+    handler = logging.StreamHandler(sys.stdout)
+    handler.terminator = "\n\n"
+    listener = QueueListener(log_queue, logging.FileHandler("file_ingest.log"), handler)
+    listener.start()
+    set_log_queue(log_queue)
+    return listener
 
 def load_single_document(file_path: str) -> Document:
     # Loads a single document from a file path
@@ -69,23 +128,8 @@ def load_single_document(file_path: str) -> Document:
         file_log("%s loading error: \n%s" % (file_path, ex))
         return None
 
-def load_document_batch(filepaths):
-    logging.info("Loading document batch")
-    # create a thread pool
-    with ThreadPoolExecutor(len(filepaths)) as exe:
-        # load files
-        futures = [exe.submit(load_single_document, name) for name in filepaths]
-        # collect data
-        if futures is None:
-            file_log(name + " failed to submit")
-            return None
-        else:
-            data_list = [future.result() for future in futures]
-            # return data and file paths
-            return (data_list, filepaths)
-        
-def load_documents(source_dir: str) -> list[Document]:
-    # Loads all documents from the source documents directory, including nested folders
+def find_documents(source_dir: str) -> list[str]:
+    # Finds all loadable documents in the source documents directory, including nested folders
     paths = []
     for root, _, files in os.walk(source_dir):
         for file_name in files:
@@ -94,61 +138,70 @@ def load_documents(source_dir: str) -> list[Document]:
             source_file_path = os.path.join(root, file_name)
             if file_extension in DOCUMENT_MAP.keys():
                 paths.append(source_file_path)
+    return paths
+
+TEXT_CHUNKING = {"chunk_size": 1000, "chunk_overlap": 200}
+PYTHON_CHUNKING = {"chunk_size": 800, "chunk_overlap": 200}
+TEXT_SPLITTER = RecursiveCharacterTextSplitter(**TEXT_CHUNKING, add_start_index=True)
+PYTHON_SPLITTER = RecursiveCharacterTextSplitter.from_language(
+    language=Language.PYTHON, **PYTHON_CHUNKING, add_start_index=True
+)
 
-    # Have at least one worker and at most INGEST_THREADS workers
-    n_workers = min(INGEST_THREADS, max(len(paths), 1))
-    chunksize = round(len(paths) / n_workers)
-    docs = []
-    with ProcessPoolExecutor(n_workers) as executor:
-        futures = []
-        # split the load operations into chunks
-        for i in range(0, len(paths), chunksize):
-            # select a chunk of filenames
-            filepaths = paths[i : (i + chunksize)]
-            # submit the task
-            try:
-                future = executor.submit(load_document_batch, filepaths)
-            except Exception as ex:
-                file_log("executor task failed: %s" % (ex))
-                future = None
-            if future is not None:
-                futures.append(future)
-        # process all results
-        for future in as_completed(futures):
-            # open the file and load the data
-            try:
-                contents, _ = future.result()
-                docs.extend(contents)
-            except Exception as ex:
-                file_log("Exception: %s" % (ex))
-
-    return docs
-
-def split_documents(documents: list[Document]) -> tuple[list[Document], list[Document]]:
-    # Splits documents for correct Text Splitter
-    text_docs, python_docs = [], []
-    for doc in documents:
-        if doc is not None:
-            file_extension = os.path.splitext(doc.metadata["source"])[1]
-            if file_extension == ".py":
-                python_docs.append(doc)
-            else:
-                text_docs.append(doc)
-    return text_docs, python_docs
+def chunk_settings(path: str) -> dict:
+    # Recorded for each file in the manifest, so a file chunked differently is stored again
+    if os.path.splitext(path)[1] == ".py":
+        return {"method": "python", **PYTHON_CHUNKING}
+    if CHUNKING == "semantic":
+        return {"method": "semantic", **SEMANTIC_CHUNKING}
+    return {"method": "recursive", **TEXT_CHUNKING}
+
+def load_and_split(job: dict) -> list:
+    # Runs in a worker process: loads one file and splits it with the splitter for its type
+    with metrics.timer("load"):
+        doc = load_single_document(job["path"])
+    if doc is None:
+        raise ValueError("could not be loaded")
+    if CHUNKING == "semantic" and os.path.splitext(job["path"])[1] != ".py":
+        chunks = semantic_chunks(doc.page_content, sentence_embedder(), SEMANTIC_CHUNKING)
+        return [(chunk, {**doc.metadata, "start_index": start}, embedding) for chunk, start, _, embedding in chunks]
+    splitter = PYTHON_SPLITTER if os.path.splitext(job["path"])[1] == ".py" else TEXT_SPLITTER
+    with metrics.timer("chunk"):
+        chunks = splitter.split_documents([doc])
+    return [(chunk.page_content, chunk.metadata) for chunk in chunks]
+
+def chunk_id(job: dict, index: int, metadata: dict) -> str:
+    # Deterministic id so run_rag.py can match vector hits with BM25 hits
+    return "%s:%s" % (metadata["source"], metadata.get("start_index", 0))
+
+def remove_source(path: str, collection, bm25: BM25Index):
+    # Drops the chunks of a file that changed or was deleted since it was stored
+    collection.delete(where={"source": path})
+    for doc_id in [doc_id for doc_id in bm25.doc_numbers if doc_id.startswith(path + ":")]:
+        bm25.remove(doc_id)
+
+def ingest_jobs(paths: list[str], manifest: Manifest, collection, bm25: BM25Index):
+    # Yields a job for every file that is not completely stored yet
+    for path in paths:
+        stat = os.stat(path)
+        entry = manifest.get(path)
+        settings = chunk_settings(path)
+        # stored chunk counts only mean something for the same chunking
+        if (entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime
+                and entry.get("settings") == settings):
+            if entry.get("done"):
+                continue
+            yield {"name": path, "path": path, "resume_from": entry.get("stored", 0)}
+            continue
+        if entry:
+            remove_source(path, collection, bm25)
+        manifest.update(path, size=stat.st_size, mtime=stat.st_mtime, settings=settings, stored=0, done=False)
+        yield {"name": path, "path": path}
 
 def main():
-        # Load documents and split in chunks
+        metrics.configure(METRICS_FORMAT, METRICS_PATH)
         logging.info(f"Loading documents from {SOURCE_DIRECTORY}")
-        documents = load_documents(SOURCE_DIRECTORY)
-        text_documents, python_documents = split_documents(documents)
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200, add_start_index=True)
-        python_splitter = RecursiveCharacterTextSplitter.from_language(
-            language=Language.PYTHON, chunk_size=800, chunk_overlap=200, add_start_index=True
-        )
-        texts = text_splitter.split_documents(text_documents)
-        texts.extend(python_splitter.split_documents(python_documents))
-        logging.info(f"Loaded {len(documents)} documents from {SOURCE_DIRECTORY}")
-        logging.info(f"Split into {len(texts)} chunks of text")
+        # largest files first so a big PDF is not the last one still being loaded
+        paths = sorted(find_documents(SOURCE_DIRECTORY), key=os.path.getsize, reverse=True)
 
         """
         (1) Chooses an appropriate langchain library based on the enbedding model name.  Matching code is contained within fun_localGPT.py.
@@ -156,17 +209,71 @@ def main():
         (2) Provides additional arguments for instructor and BGE models to improve results, pursuant to the instructions contained on
         their respective huggingface repository, project page or github repository.
         """
-        embedding_model_name = "nomic-embed-text"
-        embeddings = OllamaEmbeddings(model=embedding_model_name, show_progress=True)
+        embedding_model_name = EMBEDDING_MODEL_NAME
+        embeddings = CachedEmbeddings(
+            OllamaEmbeddings(model=embedding_model_name, show_progress=False),
+            EmbeddingCache(EMBED_CACHE_PATH),
+        )
 
         logging.info(f"Loaded embeddings from {embedding_model_name}")
 
-        db = Chroma.from_documents(
-            documents=texts,
-            embedding=embeddings,
-            persist_directory=PERSIST_DIRECTORY,
-    )   
-        
+        db = Chroma(persist_directory=PERSIST_DIRECTORY, embedding_function=embeddings)
+        manifest = Manifest(MANIFEST_PATH)
+        if RESUME:
+            bm25 = BM25Index.load(BM25_PATH)
+        else:
+            # start from an empty collection too, or rows of the old chunking stay next to the new ones
+            db.delete_collection()
+            db = Chroma(persist_directory=PERSIST_DIRECTORY, embedding_function=embeddings)
+            manifest.clear()
+            bm25 = BM25Index()
+
+        # the manifest never runs ahead of the database: progress is recorded after each write
+        def stored(job, count):
+            manifest.update(job["path"], **{**manifest.get(job["path"]), "stored": count})
+
+        def done(job, count):
+            manifest.update(job["path"], **{**manifest.get(job["path"]), "stored": count, "done": True})
+            file_log("%s stored as %d chunks" % (job["path"], count))
+
+        def checkpoint():
+            manifest.save()
+            bm25.save(BM25_PATH)
+
+        # Files are loaded and split in worker processes, embedded on a thread pool and written
+        # in batches, each stage a bounded distance ahead of the next
+        log_queue = multiprocessing.Queue()
+        listener = start_file_log(log_queue)
+        try:
+            # rows go straight to the chromadb collection, with the embeddings computed by the pipeline.
+            # Pooled vectors are unit length like those of ollama's /api/embed, so in semantic mode the
+            # remaining chunks are embedded through it too and all stored vectors rank alike
+            embedconfig = {"batch_size": EMBED_BATCH_SIZE, "workers": EMBED_WORKERS}
+            if CHUNKING == "semantic":
+                embedconfig["cache"] = embeddings.cache
+            with CollectionWriter(db._collection, batch_size=STORE_BATCH_SIZE, upsert=True, index=bm25) as writer:
+                pipeline = IngestPipeline(
+                    load_and_split, writer, embedding_model_name, embedconfig,
+                    processes=min(INGEST_THREADS, max(1, len(paths))), extract_queue=LOAD_QUEUE,
+                    checkpoint_interval=CHECKPOINT_INTERVAL, chunk_id=chunk_id,
+                    initializer=init_worker, initargs=(log_queue,),
+                )
+                pipeline.run(ingest_jobs(paths, manifest, db._collection, bm25), done, checkpoint,
+                             embed=None if CHUNKING == "semantic" else embeddings.embed_documents, on_stored=stored)
+                for path in set(manifest.keys()) - set(paths):
+                    logging.info(f"Removing deleted {path}")
+                    remove_source(path, db._collection, bm25)
+                    manifest.remove(path)
+        finally:
+            listener.stop()
+            checkpoint()
+        logging.info(f"Loaded {pipeline.sources} documents from {SOURCE_DIRECTORY}, {pipeline.failed} failed")
+        logging.info(f"Stored {writer.rows} chunks of text")
+        logging.info(f"Indexed {len(bm25)} chunks for keyword search")
+        if metrics.enabled:
+            logging.info(metrics.summary())
+            metrics.export()
+
 if __name__ == "__main__":
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(filename)s:%(lineno)s - %(message)s", level=logging.INFO
@@ -1,22 +1,112 @@
+import os, sys, time
 from langchain_community.embeddings import OllamaEmbeddings
 from langchain_community.vectorstores import Chroma
 from langchain_community.chat_models import ChatOllama
 
 from langchain.prompts import ChatPromptTemplate
-from langchain.schema.runnable import RunnablePassthrough
+from langchain.schema.runnable import RunnablePassthrough, RunnableLambda
 from langchain.schema.output_parser import StrOutputParser
+from langchain.docstore.document import Document
+
+ROOT_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+
+# Shared helpers such as the embedding cache live in the parent directory
+sys.path.append(os.path.dirname(ROOT_DIRECTORY))
+from embedcache import EmbeddingCache, CachedEmbeddings
+from embedder import embed_batch
+from context import assemble_context
+from bm25 import BM25Index, fuse
+from rerank import Reranker
+from metrics import metrics
+
+# Stage timings, set to "prometheus" or "jsonl" to write them to METRICS_PATH after each answer
+METRICS_FORMAT = "none"
+METRICS_PATH = os.path.join(ROOT_DIRECTORY, "metrics.prom")
+metrics.configure(METRICS_FORMAT, METRICS_PATH)
 
 # # Create embeddingsclear
-embeddings = OllamaEmbeddings(model="nomic-embed-text", show_progress=False)
+EMBEDDING_MODEL_NAME = "nomic-embed-text"
+embeddings = CachedEmbeddings(
+    OllamaEmbeddings(model=EMBEDDING_MODEL_NAME, show_progress=False),
+    EmbeddingCache(os.path.join(ROOT_DIRECTORY, "embed_cache.sqlite")),
+)
 
 db = Chroma(persist_directory="./DB",
             embedding_function=embeddings)
 
-# # Create retriever
+# # Create retriever, over-fetching K x OVERFETCH candidates for the reranker
+K = 5
+OVERFETCH = 4
 retriever = db.as_retriever(
     search_type="similarity",
-    search_kwargs= {"k": 5}
+    search_kwargs= {"k": K * OVERFETCH}
 )
+CONTEXT_TOKENS = 2048
+
+# # Reranker with a hard time budget, after which plain similarity order is used.
+# Set CROSS_ENCODER to e.g. "cross-encoder/ms-marco-MiniLM-L-6-v2" if sentence-transformers is installed
+CROSS_ENCODER = None
+reranker = Reranker(budget_ms=200, cross_encoder=CROSS_ENCODER)
+
+# # Keyword index written by ingest.py, fused with the vector results
+bm25 = BM25Index.load(os.path.join(ROOT_DIRECTORY, "bm25.idx"))
+LEXICAL_FAST_PATH_RATIO = 2.0
+
+def embed_candidates(texts):
+    # vectors ingest.py cached where there are any, the rest in one batched request rather than
+    # OllamaEmbeddings' one request per text, which would not fit in the rerank budget
+    vectors = embeddings.cache.get_many(embeddings.namespace, texts)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        fresh = embed_batch([texts[i] for i in missing], EMBEDDING_MODEL_NAME, retries=0, cache=embeddings.cache)
+        for i, vector in zip(missing, fresh):
+            vectors[i] = vector
+    return vectors
+
+def chunk_id(doc):
+    return "%s:%s" % (doc.metadata["source"], doc.metadata.get("start_index", 0))
+
+def hybrid_retrieve(question):
+    with metrics.timer("retrieve"):
+        return _hybrid_retrieve(question)
+
+def _hybrid_retrieve(question):
+    # Skips the embedding call when the keyword match is confident
+    lexical = bm25.search(question, K * OVERFETCH)
+    lexical_ids = [doc_id for doc_id, _ in lexical]
+    docs = {}
+    vector_ids = []
+    if not bm25.confident(question, lexical, LEXICAL_FAST_PATH_RATIO):
+        for doc in retriever.invoke(question):
+            vector_ids.append(chunk_id(doc))
+            docs[vector_ids[-1]] = doc
+    missing = [doc_id for doc_id in lexical_ids if doc_id not in docs]
+    if missing:
+        found = db.get(ids=missing)
+        for doc_id, text, metadata in zip(found["ids"], found["documents"], found["metadatas"]):
+            docs[doc_id] = Document(page_content=text, metadata=metadata or {})
+    scores = fuse(lexical_ids, vector_ids)
+    candidates = [docs[doc_id] for doc_id in sorted(scores, key=scores.get, reverse=True) if doc_id in docs]
+    # document embeddings are mostly cache hits from ingest.py
+    with metrics.timer("rerank"):
+        chosen = reranker.rerank(question, [(chunk_id(doc), doc.page_content) for doc in candidates], K,
+                                 embed=embed_candidates)
+    return [candidates[i] for i in chosen]
+
+def format_context(docs):
+    with metrics.timer("assemble"):
+        return _format_context(docs)
+
+def _format_context(docs):
+    # docs come in similarity order, start_index was recorded by the splitter in ingest.py
+    passages = [{
+        "text": doc.page_content,
+        "score": -rank,
+        "source": doc.metadata.get("source"),
+        "start": doc.metadata.get("start_index"),
+        "end": doc.metadata["start_index"] + len(doc.page_content) if "start_index" in doc.metadata else None,
+    } for rank, doc in enumerate(docs)]
+    return "\n\n".join(assemble_context(passages, CONTEXT_TOKENS))
 
 # # Create Ollama language model
 local_llm = 'llama2'
@@ -42,7 +132,7 @@ prompt = ChatPromptTemplate.from_template(template)
 
 # Create the RAG chain using LCEL with prompt printing and streaming output
 rag_chain = (
-    {"context": retriever, "question": RunnablePassthrough()}
+    {"context": RunnableLambda(hybrid_retrieve) | RunnableLambda(format_context), "question": RunnablePassthrough()}
     | prompt
     | llm
 )
@@ -50,8 +140,17 @@ rag_chain = (
 # Function to ask questions
 def ask_question(question):
     print("Answer:\n\n", end=" ", flush=True)
+    start = time.perf_counter()
+    first = True
     for chunk in rag_chain.stream(question):
+        if first and chunk.content:
+            metrics.observe("ttft", time.perf_counter() - start)
+            first = False
+        # the last chunk carries the server's prompt_eval/eval durations
+        metrics.observe_server(getattr(chunk, "response_metadata", None))
         print(chunk.content, end="", flush=True)
+    metrics.observe("total", time.perf_counter() - start)
+    metrics.export()
     print("\n")
 
 # Example usage
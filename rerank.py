@@ -0,0 +1,118 @@
+import hashlib, threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, CancelledError
+from embedcache import LRUCache
+from bm25 import tokenize
+
+try:
+    from sentence_transformers import CrossEncoder
+except ImportError:
+    CrossEncoder = None
+
+def query_hash(query):
+    return hashlib.sha256(query.encode('utf-8', errors='ignore')).hexdigest()
+
+def lexical_overlap(query_terms, text):
+    # share of the query terms that appear in the text
+    if not query_terms:
+        return 0.0
+    return len(query_terms & set(tokenize(text))) / len(query_terms)
+
+def check(cancelled):
+    if cancelled is not None and cancelled.is_set():
+        raise CancelledError()
+
+class Reranker:
+    """
+    Re-scores over-fetched candidates and picks a relevant, diverse top k with MMR.
+    Relevance comes from a local cross-encoder when sentence-transformers is installed,
+    otherwise from the candidate's similarity rank blended with lexical overlap.
+    Scores are cached by (query hash, chunk id). If reranking does not finish within
+    budget_ms the candidates are returned in their original similarity order and the
+    work stops at its next check, so late reranks do not hold up the next queries.
+    """
+    def __init__(self, budget_ms=200, lambda_mult=0.7, lexical_weight=0.3, cross_encoder=None, cache_size=4096):
+        self.budget = budget_ms / 1000
+        self.lambda_mult = lambda_mult
+        self.lexical_weight = lexical_weight
+        self.cross_encoder = None
+        if cross_encoder and CrossEncoder is not None:
+            self.cross_encoder = CrossEncoder(cross_encoder)
+        self.scores = LRUCache(cache_size)
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.fallbacks = 0
+
+    def relevance(self, query, candidates, cancelled=None):
+        """
+        candidates are (chunk id, text) in similarity order
+        """
+        key = query_hash(query)
+        scores = [self.scores.get((key, chunk_id)) for chunk_id, _ in candidates]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if missing and self.cross_encoder is not None:
+            check(cancelled)
+            predicted = self.cross_encoder.predict([(query, candidates[i][1]) for i in missing])
+            for i, score in zip(missing, predicted):
+                scores[i] = float(score)
+        elif missing:
+            terms = set(tokenize(query))
+            for i in missing:
+                check(cancelled)
+                rank_score = 1 - i / len(candidates)
+                scores[i] = (1 - self.lexical_weight) * rank_score + self.lexical_weight * lexical_overlap(terms, candidates[i][1])
+        for i in missing:
+            self.scores.put((key, candidates[i][0]), scores[i])
+        return np.asarray(scores, dtype=np.float32)
+
+    def similarity(self, candidates, embeddings):
+        # pairwise cosine of candidate embeddings, or token set overlap without them
+        if embeddings is not None:
+            vectors = np.asarray(embeddings, dtype=np.float32)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            return vectors @ vectors.T
+        sets = [set(tokenize(text)) for _, text in candidates]
+        return np.array([[len(a & b) / max(len(a | b), 1) for b in sets] for a in sets], dtype=np.float32)
+
+    def mmr(self, query, candidates, k, embeddings=None, cancelled=None):
+        relevance = self.relevance(query, candidates, cancelled)
+        # scale relevance to 0..1 so it is comparable with similarity
+        spread = relevance.max() - relevance.min()
+        relevance = (relevance - relevance.min()) / spread if spread > 0 else np.ones_like(relevance)
+        similarity = self.similarity(candidates, embeddings)
+        selected = [int(np.argmax(relevance))]
+        redundancy = similarity[selected[0]].copy()
+        while len(selected) < min(k, len(candidates)):
+            check(cancelled)
+            score = self.lambda_mult * relevance - (1 - self.lambda_mult) * redundancy
+            score[selected] = -np.inf
+            best = int(np.argmax(score))
+            selected.append(best)
+            redundancy = np.maximum(redundancy, similarity[best])
+        return selected
+
+    def rerank(self, query, candidates, k, embed=None):
+        """
+        Returns:
+          positions of the k chosen candidates, best first.
+          embed, if given, maps candidate texts to embeddings for the diversity term.
+        """
+        if len(candidates) <= 1:
+            return list(range(len(candidates)))
+
+        cancelled = threading.Event()
+
+        def work():
+            check(cancelled)
+            embeddings = embed([text for _, text in candidates]) if embed else None
+            return self.mmr(query, candidates, k, embeddings, cancelled)
+
+        future = self.executor.submit(work)
+        try:
+            return future.result(timeout=self.budget)
+        except TimeoutError:
+            # drop it if still queued, otherwise it stops between candidates;
+            # the scores computed so far stay cached for the next time
+            cancelled.set()
+            future.cancel()
+            self.fallbacks += 1
+            return list(range(min(k, len(candidates))))
@@ -0,0 +1,133 @@
+import os
+import numpy as np
+from embedder import embed_chunks
+from embedcache import EmbeddingCache
+from metrics import metrics
+from tools import sentence_spans
+
+# e.g. {"method": "semantic", "percentile": 95, "buffer": 1, "min_sentences": 2,
+#       "max_sentences": 30, "pool_sentences": 8}
+DEFAULTS = {"percentile": 95.0, "buffer": 1, "min_sentences": 1, "max_sentences": 30, "pool_sentences": 8}
+
+_embedder = None
+
+def set_sentence_embedder(embedmodel, config):
+    """
+    Sets the model and batching used to embed sentences in this process.
+    Also works as a ProcessPoolExecutor initializer, the cache is opened on first use.
+    """
+    global _embedder
+    _embedder = {"model": embedmodel, "config": dict(config), "cache": None, "pid": None}
+
+def sentence_embedder():
+    """
+    Returns a function embedding a list of sentences in large batches through the embedding cache
+    """
+    if _embedder is None:
+        raise RuntimeError("set_sentence_embedder() has not been called in this process")
+    config = dict(_embedder["config"])
+    cache_path = config.pop("cache_path", None)
+    cache_max_mb = config.pop("cache_max_mb", 1024)
+    # a forked worker must not share its parent's sqlite connection
+    if cache_path and _embedder["pid"] != os.getpid():
+        _embedder["cache"] = EmbeddingCache(cache_path, cache_max_mb)
+        _embedder["pid"] = os.getpid()
+
+    def embed(sentences):
+        return [embedding for _, embedding in embed_chunks(sentences, _embedder["model"], cache=_embedder["cache"], **config)]
+    return embed
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def adjacent_distances(vectors, buffer=1):
+    """
+    Cosine distance between each sentence and the next, all at once.
+    As in langchain's SemanticChunker each sentence is compared together with buffer
+    neighbours on either side, but the windows are sums of the sentence vectors taken
+    from one cumulative sum instead of new embeddings of the joined sentences.
+    """
+    vectors = normalize_rows(vectors)
+    if buffer:
+        count = len(vectors)
+        sums = np.vstack([np.zeros((1, vectors.shape[1]), vectors.dtype), np.cumsum(vectors, axis=0)])
+        index = np.arange(count)
+        vectors = normalize_rows(sums[np.minimum(index + buffer + 1, count)] - sums[np.maximum(index - buffer, 0)])
+    return 1.0 - np.einsum("ij,ij->i", vectors[:-1], vectors[1:])
+
+def breakpoints(distances, percentile=95.0, min_sentences=1, max_sentences=30):
+    """
+    Returns the indices of the sentences that start a new chunk, the first chunk excluded.
+    Chunks break where the distance to the next sentence is above the percentile of all
+    distances in the text, breaks closer than min_sentences to the previous one are dropped
+    and chunks longer than max_sentences are split again at their largest distance.
+    """
+    count = len(distances) + 1
+    if count < 2:
+        return []
+    candidates = np.flatnonzero(distances > np.percentile(distances, percentile)) + 1
+    starts = []
+    for start in candidates.tolist():
+        if start - (starts[-1] if starts else 0) >= min_sentences and count - start >= min_sentences:
+            starts.append(start)
+    if not max_sentences:
+        return starts
+    result = []
+    bounds = [0] + starts + [count]
+    for first, end in zip(bounds, bounds[1:]):
+        result.extend(_split(distances, first, end, max(max_sentences, 2)))
+        result.append(end)
+    return result[:-1]
+
+def _split(distances, first, end, max_sentences):
+    # both halves keep at least half of max_sentences, so an oversized chunk splits evenly enough
+    if end - first <= max_sentences:
+        return []
+    half = max_sentences // 2
+    start = first + half + int(np.argmax(distances[first + half - 1:end - half]))
+    return _split(distances, first, start, max_sentences) + [start] + _split(distances, start, end, max_sentences)
+
+def semantic_chunks(text, embed, settings):
+    """
+    Splits text where the meaning shifts between sentences.
+    All sentences go to embed in one call, which batches them, and the breakpoints come from
+    the adjacent sentence similarities. Chunks of up to pool_sentences sentences reuse the
+    sentence vectors, averaged by sentence length, as their own embedding; a mean over more
+    sentences blurs the chunk, so longer ones (or all with pool_sentences 0) get None and
+    are embedded whole like any other chunk.
+    Returns:
+      list of (chunk, start, end, embedding) where chunk == text[start:end]
+    """
+    settings = {**DEFAULTS, **settings}
+    spans = list(sentence_spans(text))
+    if not spans:
+        return []
+    vectors = normalize_rows(np.asarray(embed([text[start:end] for start, end in spans]), dtype=np.float32))
+    with metrics.timer("chunk"):
+        starts = [0] + breakpoints(adjacent_distances(vectors, int(settings["buffer"])), float(settings["percentile"]),
+                                   int(settings["min_sentences"]), int(settings["max_sentences"]))
+        ends = starts[1:] + [len(spans)]
+        lengths = np.array([end - start for start, end in spans], dtype=np.float32)
+        pooled = normalize_rows(np.add.reduceat(vectors * lengths[:, None], starts, axis=0))
+    chunks = []
+    for index, (first, end) in enumerate(zip(starts, ends)):
+        start, stop = spans[first][0], spans[end - 1][1]
+        embedding = pooled[index].tolist() if end - first <= int(settings["pool_sentences"]) else None
+        chunks.append((text[start:stop], start, stop, embedding))
+    return chunks
+
+def getsemanticconfig(config):
+    """
+    Reads the sentence embedding settings from the config dict
+    """
+    semantic = {
+        "batch_size": int(config.get("semantic_batch_size", 256)),
+        "workers": int(config.get("semantic_workers", 2)),
+        "retries": int(config.get("embed_retries", 3)),
+        "backoff": float(config.get("embed_backoff", 1.0)),
+    }
+    if config.get("embed_cache", "true").lower() == "true":
+        semantic["cache_path"] = config.get("embed_cache_path", "embed_cache.sqlite")
+        semantic["cache_max_mb"] = float(config.get("embed_cache_max_mb", 1024))
+    return semantic
@@ -0,0 +1,95 @@
+import time
+
+class TokenBuffer:
+    """
+    Collects streamed tokens in a list and joins them only when the text is read,
+    instead of copying the whole message on every token.
+    """
+    def __init__(self):
+        self.parts = []
+        self.length = 0
+        self._text = ""
+        self._joined = 0
+
+    def append(self, token):
+        if token:
+            self.parts.append(token)
+            self.length += len(token)
+
+    def text(self):
+        if self._joined < len(self.parts):
+            self._text = "".join(self.parts)
+            self._joined = len(self.parts)
+        return self._text
+
+    def __len__(self):
+        return self.length
+
+def chat_tokens(response, on_done=None):
+    """
+    Yields the content tokens of a streamed ollama.chat response.
+    on_done, if given, is called with the final chunk, which carries the server's timings.
+    """
+    for chunk in response:
+        token = chunk["message"]["content"]
+        if chunk.get("done") and on_done is not None:
+            on_done(chunk)
+        if token:
+            yield token
+
+def coalesce(tokens, interval=0.05, max_chars=512):
+    """
+    Groups tokens into deltas, emitting one when interval seconds have passed since the
+    last one or max_chars are pending. The first token is emitted right away so the
+    time to first token is unchanged.
+    """
+    pending = []
+    size = 0
+    last = None
+    for token in tokens:
+        pending.append(token)
+        size += len(token)
+        now = time.monotonic()
+        if last is None or now - last >= interval or size >= max_chars:
+            yield "".join(pending)
+            pending, size, last = [], 0, now
+    if pending:
+        yield "".join(pending)
+
+def coalesce_text(tokens, interval=0.05, max_chars=512):
+    """
+    Same cadence as coalesce, but yields the accumulated text for front ends that
+    need the full message on every update
+    """
+    buffer = TokenBuffer()
+    for delta in coalesce(tokens, interval, max_chars):
+        buffer.append(delta)
+        yield buffer.text()
+
+async def achat_tokens(response, on_done=None):
+    """
+    chat_tokens for a streamed ollama.AsyncClient.chat response
+    """
+    async for chunk in response:
+        token = chunk["message"]["content"]
+        if chunk.get("done") and on_done is not None:
+            on_done(chunk)
+        if token:
+            yield token
+
+async def acoalesce_text(tokens, interval=0.05, max_chars=512):
+    """
+    coalesce_text for an async token stream
+    """
+    buffer = TokenBuffer()
+    size = 0
+    last = None
+    async for token in tokens:
+        buffer.append(token)
+        size += len(token)
+        now = time.monotonic()
+        if last is None or now - last >= interval or size >= max_chars:
+            yield buffer.text()
+            size, last = 0, now
+    if size:
+        yield buffer.text()
@@ -1,95 +1,175 @@
-from nltk.tokenize import sent_tokenize, word_tokenize
+import re
+from collections import deque
+from functools import lru_cache
+from typing import Iterator, List, Tuple
 
-def chunker(text, max_words_per_chunk=100):
-  """
-  Splits the input text into overlapping chunks of words up to the max per chunk
-  Returns:
-    list of chunks which are strings
-  """
+Span = Tuple[int, int]
 
-  sentences = sent_tokenize(text)
-  chunks = []
-  current_chunk = []
+@lru_cache(maxsize=1)
+def sentence_tokenizer():
+    """
+    Loads the punkt sentence tokenizer used by nltk's sent_tokenize
+    """
+    try:
+        from nltk.tokenize import PunktTokenizer  # nltk >= 3.8.2
+        return PunktTokenizer()
+    except ImportError:
+        import nltk
+        return nltk.data.load('tokenizers/punkt/english.pickle')
 
-  for sentence in sentences:
-    
-      words = word_tokenize(sentence)
+WORD = re.compile(r'\S+')
 
-      if len(current_chunk) + len(words) <= max_words_per_chunk:
-          current_chunk.extend(words)
-      else:
-          chunks.append(' '.join(current_chunk))
-          current_chunk = words
+def word_spans(text: str, start: int = 0, end: int = None) -> Iterator[Span]:
+    """
+    Yields (start, end) offsets of whitespace separated words
+    """
+    for match in WORD.finditer(text, start, len(text) if end is None else end):
+        yield match.span()
 
-  # Add the last chunk if it's not empty
-  if current_chunk:
-      chunks.append(' '.join(current_chunk))
+def sentence_spans(text: str) -> Iterator[Span]:
+    """
+    Yields (start, end) offsets of sentences
+    """
+    yield from sentence_tokenizer().span_tokenize(text)
 
-  overlapping_chunks = []
-  for i in range(len(chunks)):
-      chunk_start = max(0, i - 1)
-      chunk_end = i + 1
-      overlapping_chunk = ' '.join(chunks[chunk_start:chunk_end])
-      overlapping_chunks.append(overlapping_chunk)
+def window_spans(spans: Iterator[Span], size: int, overlap: int) -> Iterator[Span]:
+    """
+    Groups unit spans into windows of size units, consecutive windows sharing overlap units.
+    Only the current window is held in memory.
+    """
+    window = deque(maxlen=size)
+    fresh = 0
+    for span in spans:
+        window.append(span)
+        fresh += 1
+        if len(window) == size and fresh >= size - overlap:
+            yield window[0][0], window[-1][1]
+            fresh = 0
+    # the units left over after the last full window, plus the overlap before them
+    if fresh:
+        yield window[max(0, len(window) - fresh - overlap)][0], window[-1][1]
 
-  return overlapping_chunks
+def check_window(units_per_chunk: int, overlap: int, unit: str):
+    if units_per_chunk < 2:
+        raise ValueError(f"The number of {unit} per chunk must be 2 or more.")
+    if overlap < 0 or overlap >= units_per_chunk - 1:
+        raise ValueError(f"Overlap must be 0 or more and less than the number of {unit} per chunk.")
 
-from typing import List
+def chunker_spans(text: str, max_words_per_chunk=100) -> Iterator[Span]:
+    """
+    Packs whole sentences into chunks of up to max_words_per_chunk words,
+    then yields each chunk joined with the one before it so neighbours overlap
+    """
+    previous = None
+    start = end = None
+    words = 0
+    for sentence_start, sentence_end in sentence_spans(text):
+        count = sum(1 for _ in word_spans(text, sentence_start, sentence_end))
+        if start is not None and words + count > max_words_per_chunk:
+            yield (previous[0] if previous else start), end
+            previous = (start, end)
+            start, words = None, 0
+        if start is None:
+            start = sentence_start
+        end = sentence_end
+        words += count
+    if start is not None:
+        yield (previous[0] if previous else start), end
 
-def chunk_text_by_sentences(source_text: str, sentences_per_chunk: int, overlap: int) -> List[str]:
+def iter_chunks(source_text: str, settings: dict) -> Iterator[Tuple[str, int, int]]:
     """
-    Splits text by sentences
+    Lazily chunks text with the method and parameters named in settings,
+    e.g. {"method": "words", "words_per_chunk": 1000, "overlap": 200}
+    Returns:
+    generator of (chunk, start, end) where chunk == source_text[start:end]
+    """
+    method = settings["method"]
+    if method == "words":
+        check_window(settings["words_per_chunk"], settings["overlap"], "words")
+        spans = window_spans(word_spans(source_text), settings["words_per_chunk"], settings["overlap"])
+    elif method == "sentences":
+        check_window(settings["sentences_per_chunk"], settings["overlap"], "sentences")
+        spans = window_spans(sentence_spans(source_text), settings["sentences_per_chunk"], settings["overlap"])
+    elif method == "chunker":
+        spans = chunker_spans(source_text, settings.get("max_words_per_chunk", 100))
+    else:
+        raise ValueError(f"Unknown chunking method: {method}")
+    for start, end in spans:
+        yield source_text[start:end], start, end
+
+def chunk_text(source_text: str, settings: dict) -> List[str]:
     """
-    if sentences_per_chunk < 2:
-        raise ValueError("The number of sentences per chunk must be 2 or more.")
-    if overlap < 0 or overlap >= sentences_per_chunk - 1:
-        raise ValueError("Overlap must be 0 or more and less than the number of sentences per chunk.")
-    
-    sentences = sent_tokenize(source_text)
-    if not sentences:
+    Chunks text with the method and parameters named in settings
+    """
+    chunks = [chunk for chunk, _, _ in iter_chunks(source_text, settings)]
+    if not chunks:
         print("Nothing to chunk")
-        return []
-    
-    chunks = []
-    i = 0
-    while i < len(sentences):
-        end = min(i + sentences_per_chunk, len(sentences))
-        chunk = sentences[i:end]
-        
-        if overlap > 0 and i > 1:
-            overlap_start = max(0, i - overlap)
-            chunk = sentences[overlap_start:end]
-        
-        chunks.append(' '.join(chunk))
-        i += sentences_per_chunk - overlap
-    
     return chunks
 
+def chunker(text, max_words_per_chunk=100):
+    """
+    Splits the input text into overlapping chunks of words up to the max per chunk
+    Returns:
+    list of chunks which are strings
+    """
+    return chunk_text(text, {"method": "chunker", "max_words_per_chunk": max_words_per_chunk})
+
+def chunk_text_by_sentences(source_text: str, sentences_per_chunk: int, overlap: int) -> List[str]:
+    """
+    Splits text by sentences
+    """
+    return chunk_text(source_text, {"method": "sentences", "sentences_per_chunk": sentences_per_chunk, "overlap": overlap})
+
 def chunk_text_by_words(source_text: str, words_per_chunk: int, overlap: int) -> List[str]:
     """
     Splits text into chunks by words with overlap.
     """
-    if words_per_chunk < 2:
-        raise ValueError("The number of sentences per chunk must be 2 or more.")
-    if overlap < 0 or overlap >= words_per_chunk - 1:
-        raise ValueError("Overlap must be 0 or more and less than the number of sentences per chunk.")
-    
-    words = word_tokenize(source_text)
-    if not words:
-        print("Nothing to chunk")
-        return []
-    
-    chunks = []
-    i = 0
-    while i < len(words):
-        end = min(i + words_per_chunk, len(words))
-        chunk = words[i:end]
-        
-        if overlap > 0 and i != 0:
-            overlap_start = max(0, i - overlap)
-            chunk = words[overlap_start:end]
-        
-        chunks.append(' '.join(chunk))
-        i += words_per_chunk - overlap
-    
-    return chunks
\ No newline at end of file
+    return chunk_text(source_text, {"method": "words", "words_per_chunk": words_per_chunk, "overlap": overlap})
+
+def iter_chunks_stream(segments: Iterator[str], settings: dict) -> Iterator[Tuple[str, int, int]]:
+    """
+    Like iter_chunks, but over a stream of text segments such as PDF pages.
+    Offsets are relative to the concatenated segments and only the current
+    window plus one segment of text is held in memory.
+    """
+    method = settings["method"]
+    if method == "words":
+        size, overlap, unit_spans = settings["words_per_chunk"], settings["overlap"], word_spans
+        check_window(size, overlap, "words")
+    elif method == "sentences":
+        size, overlap, unit_spans = settings["sentences_per_chunk"], settings["overlap"], sentence_spans
+        check_window(size, overlap, "sentences")
+    else:
+        # sentence packing needs to look back a whole chunk, so it works on the joined text
+        yield from iter_chunks("".join(segments), settings)
+        return
+
+    window = deque(maxlen=size)
+    fresh = 0
+    # buffer holds the text from global offset base, units before scanned are already in the window
+    buffer, base, scanned = "", 0, 0
+    segments = iter(segments)
+    done = False
+    while not done:
+        segment = next(segments, None)
+        done = segment is None
+        if segment:
+            buffer += segment
+        spans = [(start + scanned, end + scanned) for start, end in unit_spans(buffer[scanned:])]
+        if spans and not done:
+            # the last unit may continue in the next segment
+            spans.pop()
+        for start, end in spans:
+            window.append((start + base, end + base))
+            fresh += 1
+            if len(window) == size and fresh >= size - overlap:
+                start, end = window[0][0], window[-1][1]
+                yield buffer[start - base:end - base], start, end
+                fresh = 0
+        if spans:
+            scanned = spans[-1][1]
+        keep = window[0][0] - base if window else scanned
+        buffer, base, scanned = buffer[keep:], base + keep, scanned - keep
+    if fresh:
+        start, end = window[max(0, len(window) - fresh - overlap)][0], window[-1][1]
+        yield buffer[start - base:end - base], start, end
@@ -1,66 +1,146 @@
-import re, os, requests, magic, ollama, string, configparser
-from pdfminer.high_level import extract_text
-from urllib.parse import unquote, urlparse
-from bs4 import BeautifulSoup
+import re, os, requests, magic, configparser, codecs, tempfile, threading
+from contextlib import contextmanager
+from pdfminer.high_level import extract_pages
+from pdfminer.layout import LTTextContainer
+from html.parser import HTMLParser
 
-def get_filename_from_cd(cd):
+_session = None
+_session_lock = threading.Lock()
+
+def get_session(pool_size=16):
+    """
+    Returns the shared requests session, so connections are kept alive across URLs.
+    Fetcher threads call this at once, so only the first one builds it.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+def detect_type(head, content_type=None):
     """
-    Get filename from content-disposition
+    Detects the mime type from the first bytes, falling back to the Content-Type header
     """
-    if not cd:
-        return None
-    fname = re.findall('filename="([^"]+)"', cd)
-    if len(fname) == 0:
-        return None
-    fname = fname[0]
-    if fname.lower().startswith(("utf-8''", "utf-8'")):
-        fname = fname.split("'")[-1]
-    return unquote(fname)
-
-def download_file(url):
-    with requests.get(url, stream=True) as r:
+    filetype = magic.from_buffer(head, mime=True)
+    if filetype not in SUPPORTED_TYPES and content_type:
+        header_type = content_type.split(';')[0].strip().lower()
+        if header_type in SUPPORTED_TYPES:
+            return header_type
+    return filetype
+
+@contextmanager
+def fetch_url(url, headers=None, max_memory=32 * 1024 * 1024, timeout=30):
+    """
+    Streams a URL into a buffer that stays in memory up to max_memory bytes.
+    Returns:
+      (buffer, mime type, response) with the buffer rewound to the start,
+      or (None, None, response) if the server answered 304 Not Modified
+    """
+    with get_session().get(url, headers=headers, stream=True, timeout=timeout) as r:
+        if r.status_code == 304:
+            yield None, None, r
+            return
         r.raise_for_status()
-        cd = r.headers.get('content-disposition')
-        filename = get_filename_from_cd(cd)
-        if not filename:
-            # Use the URL to create a filename if no content-disposition header is present
-            parsed_url = urlparse(url)
-            filename = os.path.basename(parsed_url.path)
-            if not filename:
-                filename = parsed_url.netloc.replace('.', '_')
-        filename = 'content/' + filename
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        with open(filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
+        with tempfile.SpooledTemporaryFile(max_size=max_memory) as f:
+            for chunk in r.iter_content(chunk_size=65536):
                 f.write(chunk)
-        return filename
+            f.seek(0)
+            filetype = detect_type(f.read(2048), r.headers.get('content-type'))
+            f.seek(0)
+            yield f, filetype, r
 
-def readtext(path):
-    path = path.rstrip().replace(' \n', '').replace('%0A', '')
-    if re.match(r'^https?://', path):
-        filename = download_file(path)
-    else:
-        filename = os.path.abspath(path)
-    
-    filetype = magic.from_file(filename, mime=True)
-    print(f"\nEmbedding {filename} as {filetype}")
-    
-    text = ""
+class HTMLTextParser(HTMLParser):
+    """
+    Collects the text of an HTML document as it is fed, skipping scripts and styles
+    """
+    skip_tags = {'script', 'style', 'template'}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skip_tags:
+            self.skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.skip_tags and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+    def take(self):
+        text = "".join(self.parts)
+        self.parts = []
+        return text
+
+def iter_html_text(f, blocksize=1 << 16):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    parser = HTMLTextParser()
+    while block := f.read(blocksize):
+        parser.feed(decoder.decode(block))
+        if text := parser.take():
+            yield text
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    if text := parser.take():
+        yield text
+
+def iter_pdf_text(f):
+    for page in extract_pages(f):
+        text = "".join(element.get_text() for element in page if isinstance(element, LTTextContainer))
+        yield text.encode('utf-8', errors='ignore').decode('utf-8') + "\f"
+
+def iter_plain_text(f, blocksize=1 << 20):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while block := f.read(blocksize):
+        yield decoder.decode(block)
+    yield decoder.decode(b'', final=True)
+
+def clean_path(path):
+    return path.rstrip().replace(' \n', '').replace('%0A', '')
+
+def is_url(path):
+    return re.match(r'^https?://', path) is not None
+
+SUPPORTED_TYPES = ('application/pdf', 'text/plain', 'text/html')
+
+def iter_text_from_file(f, filetype):
     if filetype == 'application/pdf':
-        text = extract_text(filename)
-        text = text.encode('utf-8', errors='ignore').decode('utf-8')
+        yield from iter_pdf_text(f)
     if filetype == 'text/plain':
-        with open(filename, 'rb') as f:
-            text = f.read().decode('utf-8')    
+        yield from iter_plain_text(f)
     if filetype == 'text/html':
-        with open(filename, 'rb') as f:
-            soup = BeautifulSoup(f, 'html.parser')
-            text = soup.get_text()
-    
-    if os.path.exists(filename) and 'content/' in filename:
-        os.remove(filename)
-    
-    return text
+        yield from iter_html_text(f)
+
+def iter_text(path):
+    """
+    Yields the text of a document in pieces: page by page for PDFs, block by block for HTML and text,
+    so a whole document never has to be held in memory
+    """
+    path = clean_path(path)
+    if is_url(path):
+        with fetch_url(path) as (f, filetype, _):
+            print(f"\nEmbedding {path} as {filetype}")
+            yield from iter_text_from_file(f, filetype)
+        return
+
+    filename = os.path.abspath(path)
+    filetype = magic.from_file(filename, mime=True)
+    print(f"\nEmbedding {filename} as {filetype}")
+    with open(filename, 'rb') as f:
+        yield from iter_text_from_file(f, filetype)
+
+def readtext(path):
+    return "".join(iter_text(path))
 
 def getconfig():
   config = configparser.ConfigParser()
@@ -0,0 +1,327 @@
+import os, json, sqlite3, threading
+import numpy as np
+from quantize import make_quantizer, Int8Codes, PQCodes, BLOCK
+
+class LocalCollection:
+    """
+    In-process vector store with the subset of the Chroma collection API this project uses.
+    Vectors are normalized and appended to a memory-mapped float32 (or float16) matrix, ids,
+    documents and metadata live in SQLite. Queries are an exact cosine top-k in NumPy, or probe an
+    IVF index once build_ivf has been run. With compact codes from build_codes the search runs on
+    int8 or product-quantized codes held in memory and only the best candidates are re-ranked
+    against the matrix.
+    """
+    def __init__(self, path, name="python-rag-ollama", nprobe=8, dtype="float32", rerank=10):
+        os.makedirs(path, exist_ok=True)
+        self.name = name
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.default_dtype = dtype
+        self.path = path
+        self.matrix_path = os.path.join(path, name + ".vectors")
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(os.path.join(path, name + ".sqlite"), check_same_thread=False)
+        self.load()
+
+    def load(self):
+        self.db.execute("CREATE TABLE IF NOT EXISTS rows (row INTEGER PRIMARY KEY, id TEXT, document TEXT, metadata TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS rows_id ON rows(id)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+        info = dict(self.db.execute("SELECT key, value FROM info"))
+        # read before the matrix, so a write that lands during the load triggers another one
+        self.generation = int(info.get("generation", 0))
+        self.dim = int(info["dim"]) if "dim" in info else None
+        # an existing matrix keeps the dtype it was written with
+        self.dtype = np.dtype(info.get("dtype", self.default_dtype))
+        self.rows = os.path.getsize(self.matrix_path) // (self.dtype.itemsize * self.dim) if self.dim and os.path.exists(self.matrix_path) else 0
+        # rows that were deleted or replaced by an upsert stay in the matrix but are masked out
+        self.live = np.zeros(self.rows, dtype=bool)
+        self.row_of = {}
+        for row, id in self.db.execute("SELECT row, id FROM rows WHERE row < ?", (self.rows,)):
+            self.live[row] = True
+            self.row_of[id] = row
+        self.matrix = None
+        self.ivf = self.load_ivf()
+        self.codes = self.load_codes()
+
+    def _generation(self):
+        row = self.db.execute("SELECT value FROM info WHERE key = 'generation'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _bump(self):
+        # every write or reset moves the generation on, so readers in other processes reload
+        self.generation = self._generation() + 1
+        self.db.execute("INSERT OR REPLACE INTO info VALUES ('generation', ?)", (str(self.generation),))
+
+    def refresh(self):
+        """
+        Reloads if another process, such as import.py, wrote to or reset the collection since
+        it was loaded. A rebuild with the same number of rows changes the generation too.
+        """
+        with self.lock:
+            if self._generation() != self.generation:
+                self.load()
+
+    def count(self):
+        return len(self.row_of)
+
+    def _matrix(self):
+        if self.matrix is None and self.rows:
+            self.matrix = np.memmap(self.matrix_path, dtype=self.dtype, mode='r', shape=(self.rows, self.dim))
+        return self.matrix
+
+    def _encode(self, embeddings):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _write(self, vectors):
+        with open(self.matrix_path, 'ab') as f:
+            f.write(vectors.astype(self.dtype).tobytes())
+
+    def _scan(self, query, rows=None):
+        """
+        Exact scores of query against all rows of the matrix, or the given rows,
+        converted to float32 one block at a time
+        """
+        matrix = self._matrix()
+        if rows is not None:
+            return np.asarray(matrix[rows], dtype=np.float32) @ query
+        return np.concatenate([np.asarray(matrix[i:i + BLOCK], dtype=np.float32) @ query
+                               for i in range(0, len(matrix), BLOCK)])
+
+    def add(self, ids, embeddings, documents=None, metadatas=None):
+        with self.lock:
+            existing = [id for id in ids if id in self.row_of]
+            if existing:
+                print(f"Skipping {len(existing)} existing ids, use upsert to replace them")
+                keep = [i for i, id in enumerate(ids) if id not in self.row_of]
+                ids = [ids[i] for i in keep]
+                embeddings = [embeddings[i] for i in keep]
+                documents = [documents[i] for i in keep] if documents else None
+                metadatas = [metadatas[i] for i in keep] if metadatas else None
+            self.upsert(ids, embeddings, documents, metadatas)
+
+    def upsert(self, ids, embeddings, documents=None, metadatas=None):
+        if not ids:
+            return
+        with self.lock:
+            vectors = self._encode(embeddings)
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self.db.execute("INSERT OR REPLACE INTO info VALUES ('dim', ?)", (str(self.dim),))
+                self.db.execute("INSERT OR REPLACE INTO info VALUES ('dtype', ?)", (self.dtype.name,))
+            self.delete(ids=[id for id in ids if id in self.row_of])
+            start = self.rows
+            self._write(vectors)
+            self.db.executemany("INSERT INTO rows VALUES (?, ?, ?, ?)", [
+                (start + i, id, documents[i] if documents else None, json.dumps(metadatas[i]) if metadatas else None)
+                for i, id in enumerate(ids)])
+            self._bump()
+            self.db.commit()
+            self.rows += len(ids)
+            self.live = np.concatenate([self.live, np.ones(len(ids), dtype=bool)])
+            self.row_of.update((id, start + i) for i, id in enumerate(ids))
+            self.matrix = None
+            if self.ivf is not None:
+                centroids, assignments = self.ivf
+                self.ivf = centroids, np.concatenate([assignments, np.argmax(vectors @ centroids.T, axis=1)])
+            if self.codes is not None:
+                quantizer, codes = self.codes
+                self.codes = quantizer, np.concatenate([codes, quantizer.encode(vectors)])
+
+    def delete(self, ids):
+        with self.lock:
+            rows = [self.row_of.pop(id) for id in ids if id in self.row_of]
+            if rows:
+                self.live[rows] = False
+                self.db.executemany("DELETE FROM rows WHERE row = ?", [(row,) for row in rows])
+                self._bump()
+                self.db.commit()
+
+    def _rows(self, rows, include):
+        """
+        Looks up the ids, documents and metadata of matrix rows in order. Rows another process
+        deleted since the last refresh are skipped.
+        Returns:
+          (result, positions in rows of the rows found)
+        """
+        result = {"ids": [], "documents": [], "metadatas": []}
+        found = []
+        with self.lock:
+            for position, row in enumerate(rows):
+                record = self.db.execute("SELECT id, document, metadata FROM rows WHERE row = ?", (int(row),)).fetchone()
+                if record is None:
+                    continue
+                id, document, metadata = record
+                found.append(position)
+                result["ids"].append(id)
+                result["documents"].append(document)
+                result["metadatas"].append(json.loads(metadata) if metadata else None)
+        return {key: value for key, value in result.items() if key == "ids" or key in include}, found
+
+    def get(self, ids, include=("documents", "metadatas")):
+        return self._rows([self.row_of[id] for id in ids if id in self.row_of], include)[0]
+
+    def _candidates(self, query, nprobe):
+        if self.ivf is None:
+            return None
+        centroids, assignments = self.ivf
+        lists = np.argsort(-(centroids @ query))[:nprobe]
+        return np.flatnonzero(np.isin(assignments, lists) & self.live)
+
+    def query(self, query_embeddings, n_results=10, include=("documents", "metadatas", "distances")):
+        self.refresh()
+        matrix = self._matrix()
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for query in self._encode(query_embeddings):
+            if matrix is None:
+                rows, scores = np.array([], dtype=int), np.array([], dtype=np.float32)
+            else:
+                rows = self._candidates(query, self.nprobe)
+                if self.codes is not None:
+                    # approximate scores on the codes, then exact scores for the best few
+                    quantizer, codes = self.codes
+                    if rows is None:
+                        approx = quantizer.scores(query, codes)
+                        approx[~self.live] = -np.inf
+                        rows = np.arange(len(approx))
+                    else:
+                        approx = quantizer.scores(query, codes[rows])
+                    rows = rows[self._top(approx, n_results * self.rerank)]
+                    scores = self._scan(query, rows)
+                elif rows is None:
+                    scores = self._scan(query)
+                    scores[~self.live] = -np.inf
+                    rows = np.arange(len(scores))
+                else:
+                    scores = self._scan(query, rows)
+                top = self._top(scores, n_results)
+                rows, scores = rows[top], scores[top]
+            found, positions = self._rows(rows, include)
+            for key in ("ids", "documents", "metadatas"):
+                if key in found:
+                    results[key].append(found[key])
+            results["distances"].append((1 - scores[positions]).tolist())
+        return {key: value for key, value in results.items() if key == "ids" or key in include}
+
+    def _top(self, scores, k):
+        # positions of the k best finite scores, best first
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k == 0:
+            return np.array([], dtype=int)
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])]
+
+    def _sample(self, sample, seed=0):
+        live = np.flatnonzero(self.live)
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(live, min(sample, len(live)), replace=False))
+        return np.asarray(self._matrix()[rows], dtype=np.float32)
+
+    def build_codes(self, kind="int8", pq_m=16, sample=100000):
+        """
+        Trains int8 or product quantization on a sample of the vectors and encodes all of them.
+        The codes are kept in memory for search, the matrix is only read to re-rank.
+        """
+        if self._matrix() is None or not self.live.any():
+            return
+        quantizer = make_quantizer(kind, pq_m).fit(self._sample(sample))
+        codes = np.concatenate([quantizer.encode(np.asarray(self.matrix[i:i + BLOCK], dtype=np.float32))
+                                for i in range(0, self.rows, BLOCK)])
+        self.codes = quantizer, codes
+        np.savez(os.path.join(self.path, self.name + ".quantizer.npz"), kind=quantizer.kind, **quantizer.params())
+        np.save(os.path.join(self.path, self.name + ".codes.npy"), codes)
+        with self.lock:
+            self._bump()
+            self.db.commit()
+
+    def load_codes(self):
+        quantizer_path = os.path.join(self.path, self.name + ".quantizer.npz")
+        codes_path = os.path.join(self.path, self.name + ".codes.npy")
+        if not os.path.exists(quantizer_path):
+            return None
+        codes = np.load(codes_path)
+        if len(codes) != self.rows:
+            return None
+        params = dict(np.load(quantizer_path))
+        quantizer = Int8Codes() if str(params.pop("kind")) == "int8" else PQCodes()
+        return quantizer.load(params), codes
+
+    def build_ivf(self, n_lists=None, iterations=10, sample=100000, seed=0):
+        """
+        Clusters the live vectors with k-means so queries only scan the closest lists.
+        Worth it from roughly a hundred thousand chunks up.
+        """
+        matrix = self._matrix()
+        if matrix is None or not self.live.any():
+            return
+        n_lists = n_lists or max(1, int(np.sqrt(self.live.sum())))
+        rng = np.random.default_rng(seed)
+        train = self._sample(sample, seed)
+        centroids = train[rng.choice(len(train), min(n_lists, len(train)), replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(train @ centroids.T, axis=1)
+            for i in range(len(centroids)):
+                members = train[assignment == i]
+                if len(members):
+                    centroid = members.mean(axis=0)
+                    centroids[i] = centroid / max(np.linalg.norm(centroid), 1e-12)
+        assignments = np.empty(self.rows, dtype=np.int32)
+        for start in range(0, self.rows, BLOCK):
+            block = np.asarray(matrix[start:start + BLOCK], dtype=np.float32)
+            assignments[start:start + BLOCK] = np.argmax(block @ centroids.T, axis=1)
+        self.ivf = centroids, assignments
+        np.save(os.path.join(self.path, self.name + ".centroids.npy"), centroids)
+        np.save(os.path.join(self.path, self.name + ".lists.npy"), assignments)
+        with self.lock:
+            self._bump()
+            self.db.commit()
+
+    def load_ivf(self):
+        centroids_path = os.path.join(self.path, self.name + ".centroids.npy")
+        lists_path = os.path.join(self.path, self.name + ".lists.npy")
+        if not os.path.exists(centroids_path):
+            return None
+        assignments = np.load(lists_path)
+        if len(assignments) != self.rows:
+            # vectors were added without updating the index, it has to be rebuilt
+            return None
+        return np.load(centroids_path), assignments
+
+    def reset(self):
+        with self.lock:
+            generation = self._generation()
+            self.db.execute("DELETE FROM rows")
+            self.db.execute("DELETE FROM info")
+            self.db.execute("INSERT INTO info VALUES ('generation', ?)", (str(generation + 1),))
+            self.db.commit()
+            for suffix in (".vectors", ".centroids.npy", ".lists.npy", ".quantizer.npz", ".codes.npy"):
+                if os.path.exists(os.path.join(self.path, self.name + suffix)):
+                    os.remove(os.path.join(self.path, self.name + suffix))
+            self.dim, self.rows, self.matrix, self.ivf, self.codes = None, 0, None, None, None
+            self.generation = generation + 1
+            self.dtype = np.dtype(self.default_dtype)
+            self.live = np.zeros(0, dtype=bool)
+            self.row_of = {}
+
+def open_collection(config, name="python-rag-ollama", reset=False):
+    """
+    Opens the vector collection selected by vector_backend in the config dict:
+    chroma talks to the Chroma server, local uses an in-process LocalCollection
+    """
+    if config.get("vector_backend", "chroma") == "local":
+        collection = LocalCollection(config.get("vector_path", "vectors"), name, int(config.get("ivf_nprobe", 8)),
+                                     config.get("vector_dtype", "float32"), int(config.get("vector_rerank", 10)))
+        if reset:
+            print('deleting collection')
+            collection.reset()
+        return collection
+
+    import chromadb
+    chroma = chromadb.HttpClient(host="localhost", port=8000)
+    if reset and any(collection.name == name for collection in chroma.list_collections()):
+        print('deleting collection')
+        chroma.delete_collection(name)
+    return chroma.get_or_create_collection(name=name, metadata={"hnsw:space": "cosine"})
@@ -0,0 +1,62 @@
+import time
+from metrics import metrics
+
+class CollectionWriter:
+    """
+    Buffers rows for a Chroma collection and writes them in bulk add/upsert calls.
+    Documents are also added to the lexical index if one is given.
+    """
+    def __init__(self, collection, batch_size=500, upsert=False, index=None):
+        self.collection = collection
+        self.index = index
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self.ids, self.embeddings, self.documents, self.metadatas = [], [], [], []
+        self.rows = 0
+        self.write_time = 0.0
+        self.starttime = time.time()
+
+    def add(self, id, embedding, document, metadata):
+        self.ids.append(id)
+        self.embeddings.append(embedding)
+        self.documents.append(document)
+        self.metadatas.append(metadata)
+        if self.index is not None:
+            self.index.add(id, document)
+        if len(self.ids) >= self.batch_size:
+            self.flush()
+
+    def delete(self, ids):
+        self.flush()
+        self.collection.delete(ids=ids)
+        if self.index is not None:
+            for id in ids:
+                self.index.remove(id)
+
+    def flush(self):
+        if not self.ids:
+            return
+        write = self.collection.upsert if self.upsert else self.collection.add
+        start = time.time()
+        with metrics.timer("store"):
+            write(ids=self.ids, embeddings=self.embeddings, documents=self.documents, metadatas=self.metadatas)
+        self.write_time += time.time() - start
+        self.rows += len(self.ids)
+        self.ids, self.embeddings, self.documents, self.metadatas = [], [], [], []
+
+    def rate(self):
+        """
+        Returns rows written per second of wall time since the writer was created
+        """
+        elapsed = time.time() - self.starttime
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        print(f"\nStored {self.rows} rows at {self.rate():.1f} rows/sec ({self.write_time:.2f}s spent writing)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        return False